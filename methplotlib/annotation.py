@@ -5,6 +5,9 @@ import sys
 from plotly.colors import DEFAULT_PLOTLY_COLORS as plcolors
 import gzip
 import logging
+from pathlib import Path
+
+ANNOTATION_COLUMNS = ["chromosome", "begin", "end", "strand", "gene", "transcript"]
 
 
 class Transcript(object):
@@ -32,12 +35,18 @@ def good_record(line, chromosome):
     Filtering on the gtf lines
     by checking for right chromosome and right feature type
     """
-    if line.startswith(str(chromosome)) and line.split("\t")[2] in ["exon", "gene"]:
+    if line.startswith(str(chromosome)) and is_record(line):
         return True
     else:
         return False
 
 
+def is_record(line, features=("exon", "gene")):
+    """Check that the gtf line is a complete record of one of the features, skipping comments"""
+    fields = line.split("\t")
+    return not line.startswith("#") and len(fields) >= 9 and fields[2] in features
+
+
 def get_features(gtfline, type="gtf"):
     """
     Extract the desirable features from a gtf record
@@ -76,6 +85,39 @@ def transcripts_in_window(df, window, feature="transcript"):
     ].unique()
 
 
+def assemble_transcripts(df, window, feature="transcript"):
+    """
+    Return a Transcript for every transcript (or gene) in the window, in order of the records
+
+    The records of all selected features are sorted once by feature and begin,
+    after which the exons of every feature are a slice of the sorted arrays
+    The gene and strand are taken from the first record of the feature
+    Records without a name for feature (e.g. gene records for transcripts) are ignored
+    """
+    import numpy as np
+
+    df = df.loc[df[feature].notna()]
+    names = transcripts_in_window(df, window, feature=feature)
+    if len(names) == 0:
+        return []
+    codes = pd.Categorical(df[feature], categories=names).codes
+    selected = df.loc[codes >= 0].assign(code=codes[codes >= 0])
+    first = selected.drop_duplicates("code").set_index("code").sort_index()
+    selected = selected.sort_values(["code", "begin"], kind="mergesort")
+    bounds = np.flatnonzero(np.diff(selected["code"].to_numpy())) + 1
+    begins = np.split(selected["begin"].to_numpy(), bounds)
+    ends = np.split(selected["end"].to_numpy(), bounds)
+    return [
+        Transcript(
+            transcript=name if feature == "transcript" else gene,
+            gene=gene,
+            exon_tuples=zip(b.tolist(), e.tolist()),
+            strand=strand,
+        )
+        for name, gene, strand, b, e in zip(names, first["gene"], first["strand"], begins, ends)
+    ]
+
+
 def assign_colors_to_genes(transcripts):
     genes = set([t.gene for t in transcripts])
     colordict = {g: c for g, c in zip(genes, plcolors * 100)}
@@ -88,55 +130,205 @@ def parse_annotation(gtff, window, simplify=False):
     Parse the gtff and select the relevant region as determined by the window
     return as Transcript objects
     """
-    type = annot_file_sniffer(gtff)
-    logging.info(f"Parsing {type} file...")
-    df = pd.DataFrame(
-        data=[
-            get_features(line, type=type)
-            for line in open_gtf(gtff)
-            if good_record(line, window.chromosome)
-        ],
-        columns=["chromosome", "begin", "end", "strand", "gene", "transcript"],
-    )
+    df = load_annotation(gtff, window)
     logging.info("Loaded GTF file, processing...")
     if simplify:
-        df.drop_duplicates(subset=["chromosome", "begin", "end", "gene"], inplace=True)
-        res = []
-        for g in transcripts_in_window(df, window, feature="gene"):
-            gtable = df.loc[df["gene"] == g]
-            if len(gtable):
-                res.append(
-                    Transcript(
-                        transcript=gtable["gene"].tolist()[0],
-                        gene=gtable["gene"].tolist()[0],
-                        exon_tuples=gtable.loc[:, ["begin", "end"]]
-                        .sort_values("begin")
-                        .itertuples(index=False, name=None),
-                        strand=gtable["strand"].tolist()[0],
-                    )
-                )
+        df = df.drop_duplicates(subset=["chromosome", "begin", "end", "gene"])
+        res = assemble_transcripts(df, window, feature="gene")
         sys.stderr.write(f"Found {len(res)} gene(s) in the region.\n")
         logging.info(f"Found {len(res)} gene(s) in the region.\n")
     else:
-        res = []
-        for t in transcripts_in_window(df, window, feature="transcript"):
-            tr = df.loc[df["transcript"] == t]
-            res.append(
-                Transcript(
-                    transcript=t,
-                    gene=tr["gene"].tolist()[0],
-                    exon_tuples=tr.loc[:, ["begin", "end"]]
-                    .sort_values("begin")
-                    .itertuples(index=False, name=None),
-                    strand=tr["strand"].tolist()[0],
-                )
-            )
+        res = assemble_transcripts(df, window, feature="transcript")
         sys.stderr.write(f"Found {len(res)} transcript(s) in the region.\n")
         logging.info(f"Found {len(res)} transcript(s) in the region.\n")
     assign_colors_to_genes(res)
     return res
 
 
+def load_annotation(gtff, window):
+    """
+    Return the records of the gtff relevant for the window as a DataFrame
+
+    Using the store made by 'methplotlib annotation-index' if it is up to date,
+    or the tabix index of the gtff if present, and parsing the full file otherwise
+    """
+    store = store_path(gtff)
+    if Path(store).is_file() and Path(store).stat().st_mtime >= Path(gtff).stat().st_mtime:
+        logging.info(f"Querying annotation store {store}...")
+        return query_store(store, window)
+    type = annot_file_sniffer(gtff)
+    if Path(gtff + ".tbi").is_file():
+        logging.info(f"Querying tabix indexed {type} file...")
+        return fetch_tabix(gtff, window, type=type)
+    logging.info(f"Parsing {type} file...")
+    return pd.DataFrame(
+        data=[
+            get_features(line, type=type)
+            for line in open_gtf(gtff)
+            if good_record(line, window.chromosome)
+        ],
+        columns=ANNOTATION_COLUMNS,
+    )
+
+
+def store_path(gtff):
+    return gtff + ".annotation.npz"
+
+
+def records_in_window(df, window):
+    """
+    Select the records of the genes with a record of which the begin or end is in the window
+
+    Which includes all records required by parse_annotation, with or without simplify
+    """
+    df = df.loc[df["gene"].notna()]
+    in_window = df["begin"].between(window.begin, window.end) | df["end"].between(
+        window.begin, window.end
+    )
+    return df.loc[df["gene"].isin(df.loc[in_window, "gene"].unique())]
+
+
+def fetch_tabix(gtff, window, type="gtf"):
+    """
+    Fetch the records relevant for the window from a bgzip compressed and tabix indexed gtff
+
+    Records overlapping the window are fetched first, after which the region spanned
+    by the records of their genes is fetched to complete the transcripts.
+    Gene and transcript records span all exons, and the region is widened
+    until it spans all records of the genes found in it.
+    Transcript records are only used for this, and not returned.
+    Genes without gene or transcript records are completed from the full chromosome.
+    """
+    import pysam
+
+    def fetch(tabix, begin, end):
+        try:
+            lines = tabix.fetch(str(window.chromosome), max(begin - 1, 0), end)
+        except ValueError:  # chromosome not in the index
+            return pd.DataFrame(columns=ANNOTATION_COLUMNS + ["feature"])
+        return pd.DataFrame(
+            data=[
+                get_features(line, type=type) + [line.split("\t")[2]]
+                for line in lines
+                if is_record(line, features=("exon", "gene", "transcript"))
+            ],
+            columns=ANNOTATION_COLUMNS + ["feature"],
+        )
+
+    with pysam.TabixFile(gtff) as tabix:
+        df = fetch(tabix, window.begin, window.end)
+        genes = records_in_window(df.loc[df["feature"] != "transcript"], window)["gene"].unique()
+        begin, end = window.begin, window.end
+        while True:
+            df = df.loc[df["gene"].isin(genes)]
+            if len(df) == 0 or (df["begin"].min() >= begin and df["end"].max() <= end):
+                break
+            begin = min(begin, int(df["begin"].min()))
+            end = max(end, int(df["end"].max()))
+            df = fetch(tabix, begin, end)
+        if len(set(genes) - set(df.loc[df["feature"] != "exon", "gene"])) > 0:
+            # without gene and transcript records an intron can't be told from the end of a gene
+            df = fetch(tabix, 0, None)
+            df = df.loc[df["gene"].isin(genes)]
+    return df.loc[df["feature"] != "transcript", ANNOTATION_COLUMNS]
+
+
+def query_store(store, window):
+    """Return the records relevant for the window from a store made by index_annotation"""
+    import json
+    import numpy as np
+    from methplotlib.cache import arrays_to_frame
+
+    with np.load(store, allow_pickle=False) as npz:
+        meta = json.loads(str(npz["meta"]))
+        description = meta["chromosomes"].get(str(window.chromosome))
+        if description is None:
+            return pd.DataFrame(columns=ANNOTATION_COLUMNS)
+        keys = {c["name"]: c["key"] for c in description["columns"]}
+        begin, end, gene = npz[keys["begin"]], npz[keys["end"]], npz[keys["gene"]]
+        in_window = ((begin >= window.begin) & (begin <= window.end)) | (
+            (end >= window.begin) & (end <= window.end)
+        )
+        # records without gene name are coded as -1
+        genes = np.unique(gene[in_window & (gene >= 0)])
+        rows = np.flatnonzero(np.isin(gene, genes))
+        return arrays_to_frame(npz, description, rows=rows)
+
+
+def index_annotation(gtff, outfile=None):
+    """
+    Parse the gtff once and write the records per chromosome to a store for query_store
+
+    The store is a numpy npz file in which the columns of every chromosome
+    are stored as arrays as for the --cache, sorted by begin
+    Returns the name of the store
+    """
+    import json
+    import os
+    import tempfile
+    import numpy as np
+    from methplotlib.cache import frame_to_arrays
+
+    outfile = outfile or store_path(gtff)
+    type = annot_file_sniffer(gtff)
+    logging.info(f"Indexing {type} file {gtff}.")
+    df = pd.DataFrame(
+        data=[
+            get_features(line, type=type)
+            for line in open_gtf(gtff)
+            if is_record(line)
+        ],
+        columns=ANNOTATION_COLUMNS,
+    )
+    arrays = {}
+    meta = dict(
+        source=os.path.abspath(gtff),
+        chromosomes={
+            str(chromosome): frame_to_arrays(
+                records.sort_values("begin").reset_index(drop=True),
+                f"c{i}",
+                arrays,
+            )
+            for i, (chromosome, records) in enumerate(df.groupby("chromosome", sort=False))
+        },
+    )
+    arrays["meta"] = np.array(json.dumps(meta))
+    Path(outfile).parent.mkdir(parents=True, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=Path(outfile).parent, suffix=".tmp")
+    with os.fdopen(fd, "wb") as f:
+        np.savez(f, **arrays)
+    os.chmod(tmp, 0o644)
+    os.replace(tmp, outfile)
+    return outfile
+
+
+def index_main(argv=None):
+    args = get_index_args(argv)
+    for gtff in args.files:
+        store = index_annotation(gtff, outfile=args.outfile)
+        sys.stderr.write(f"Indexed {gtff} as {store}\n")
+
+
+def get_index_args(argv=None):
+    from argparse import ArgumentParser
+
+    parser = ArgumentParser(
+        prog="methplotlib annotation-index",
+        description="Parse gtf or gff files once to a store for fast access to windows",
+    )
+    parser.add_argument("files", nargs="+", help="gtf or gff files to index")
+    parser.add_argument(
+        "-o",
+        "--outfile",
+        help="Name of the store (only for a single file). "
+        "Default: the input with extension .annotation.npz, which is used automatically",
+    )
+    args = parser.parse_args(argv)
+    if args.outfile and len(args.files) > 1:
+        sys.exit("INPUT ERROR: --outfile can only be used when indexing a single file!")
+    return args
+
+
 def annot_file_sniffer(annot_file):
     """
     Figure out type of annotation file
@@ -0,0 +1,165 @@
+import numpy as np
+import pandas as pd
+import os
+import json
+import hashlib
+import logging
+import tempfile
+from pathlib import Path
+from methplotlib.version import __version__
+
+# to be incremented when the layout of the parsed tables changes
+CACHE_FORMAT = 3
+
+
+def cache_key(filename, window, args):
+    """
+    Key of the parsed data of filename in window
+
+    Based on the path, size and modification time of the input
+    and the options that change the parsed result (--mods and --smooth)
+    Only stats the file, which doesn't require opening it
+    """
+    stat = os.stat(filename)
+    key = [
+        __version__,
+        CACHE_FORMAT,
+        os.path.abspath(filename),
+        stat.st_size,
+        stat.st_mtime_ns,
+        str(window.chromosome),
+        window.begin,
+        window.end,
+        args.mods,
+        args.smooth,
+    ]
+    return hashlib.sha1(json.dumps(key).encode()).hexdigest()
+
+
+def load(cache_dir, key, name):
+    """
+    Return the list of Modification objects stored under key, or None if not cached
+
+    The objects are named after name (-n/--names), which is not part of the key
+    Reading an entry updates its modification time, used for LRU eviction
+    """
+    from methplotlib.import_methylation import Modification
+
+    path = Path(cache_dir) / f"{key}.npz"
+    try:
+        with np.load(path, allow_pickle=False) as npz:
+            meta = json.loads(str(npz["meta"]))
+            mods = [
+                Modification(
+                    table=arrays_to_frame(npz, m["table"]),
+                    data_type=m["data_type"],
+                    name=name + m["suffix"],
+                    called_sites=m["called_sites"],
+                    start_end_table=arrays_to_frame(npz, m["start_end_table"])
+                    if m["start_end_table"]
+                    else None,
+                )
+                for m in meta
+            ]
+        os.utime(path)
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        logging.warning(f"Ignoring unreadable cache entry {path}: {e}")
+        return None
+    return mods
+
+
+def store(cache_dir, key, name, mods, max_size=1024):
+    """
+    Store the list of Modification objects under key
+
+    Only the part of their names after name (e.g. the modification) is stored,
+    so the data is reused when the dataset is renamed
+    The entry is written to a temporary file and moved in place,
+    after which the cache is trimmed to max_size (MB)
+    """
+    Path(cache_dir).mkdir(parents=True, exist_ok=True)
+    arrays = {}
+    meta = [
+        dict(
+            data_type=m.data_type,
+            suffix=m.name[len(name):] if m.name.startswith(name) else "",
+            called_sites=int(m.called_sites),
+            table=frame_to_arrays(m.table, f"m{i}_t", arrays),
+            start_end_table=frame_to_arrays(m.start_end_table, f"m{i}_s", arrays)
+            if m.start_end_table is not None
+            else None,
+        )
+        for i, m in enumerate(mods)
+    ]
+    arrays["meta"] = np.array(json.dumps(meta))
+    fd, tmp = tempfile.mkstemp(dir=cache_dir, suffix=".tmp")
+    with os.fdopen(fd, "wb") as f:
+        np.savez(f, **arrays)
+    os.replace(tmp, Path(cache_dir) / f"{key}.npz")
+    evict(cache_dir, max_size)
+
+
+def evict(cache_dir, max_size):
+    """Remove the least recently used entries until the cache is below max_size (MB)"""
+    entries = []
+    for path in Path(cache_dir).glob("*.npz"):
+        try:
+            stat = path.stat()
+        except FileNotFoundError:  # removed by another process
+            continue
+        entries.append((stat.st_mtime, stat.st_size, path))
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total <= max_size * 1e6:
+            break
+        logging.info(f"Evicting {path} from the cache.")
+        try:
+            path.unlink()
+        except FileNotFoundError:
+            pass
+        total -= size
+
+
+def frame_to_arrays(df, prefix, arrays):
+    """
+    Add the columns of df as arrays to the dict arrays and return a description of df
+
+    Object and categorical columns are stored as codes and unique values (as strings),
+    with missing values coded as -1
+    A named index is stored as a column and restored by arrays_to_frame
+    """
+    index = df.index.name
+    if index is not None:
+        df = df.reset_index()
+    columns = []
+    for j, (column, values) in enumerate(df.items()):
+        kind = "category" if isinstance(values.dtype, pd.CategoricalDtype) else str(values.dtype)
+        if kind in ["object", "category"]:
+            codes, uniques = pd.factorize(values)
+            arrays[f"{prefix}_{j}"] = codes.astype(np.int32)
+            arrays[f"{prefix}_{j}_uniques"] = np.asarray(uniques, dtype=str)
+        else:
+            arrays[f"{prefix}_{j}"] = values.to_numpy()
+        columns.append(dict(name=column, key=f"{prefix}_{j}", kind=kind))
+    return dict(columns=columns, index=index)
+
+
+def arrays_to_frame(npz, description, rows=None):
+    """Rebuild a DataFrame stored by frame_to_arrays, optionally only the selected rows"""
+    data = {}
+    for column in description["columns"]:
+        values = npz[column["key"]]
+        if rows is not None:
+            values = values[rows]
+        if column["kind"] in ["object", "category"]:
+            uniques = npz[column["key"] + "_uniques"].astype(object)
+            values = pd.Categorical.from_codes(values, categories=uniques)
+            if column["kind"] == "object":
+                values = np.asarray(values, dtype=object)
+        data[column["name"]] = values
+    df = pd.DataFrame(data, columns=[c["name"] for c in description["columns"]])
+    if description["index"] is not None:
+        df = df.set_index(description["index"])
+    return df
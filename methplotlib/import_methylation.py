@@ -1,10 +1,52 @@
 import pandas as pd
-import pyranges as pr
 import numpy as np
 import sys
 import logging
+from io import StringIO
 from methplotlib.utils import file_sniffer, flatten
-from itertools import repeat
+
+NANOPOLISH_DTYPES = {
+    "chromosome": str,
+    "strand": str,
+    "start": np.int64,
+    "end": np.int64,
+    "read_name": str,
+    "log_lik_ratio": np.float64,
+    "log_lik_methylated": np.float64,
+    "log_lik_unmethylated": np.float64,
+    "num_calling_strands": np.int64,
+    "num_motifs": np.int64,
+    "sequence": str,
+    "num_motifs_in_group": np.int64,
+    "called_sites": np.int64,
+    "called_sites_methylated": np.int64,
+    "methylated_frequency": np.float64,
+    "group_sequence": str,
+}
+BEDGRAPH_DTYPES = {"Chromosome": str, "Start": np.int64, "End": np.int64, "Value": np.float64}
+BEDMETHYL_DTYPES = {0: str, 1: np.int64, 2: np.int64, 3: str}
+
+# columns of nanopolish output which are not used and therefore not parsed
+NANOPOLISH_UNUSED = [
+    "log_lik_methylated",
+    "log_lik_unmethylated",
+    "num_calling_strands",
+    "num_motifs",
+    "sequence",
+    "num_motifs_in_group",
+    "called_sites_methylated",
+    "group_sequence",
+]
+
+_tabix_readers = {}
+# open bam/cram files and the sniffed type of every input, reused for every window
+_alignment_files = {}
+_file_types = {}
+# windows of a batch run (--windows) and the records of unindexed inputs overlapping them
+_batch_windows = []
+_preloaded = {}
+# single process executors, reused for every window (see worker_pool)
+_workers = []
 
 
 class Modification(object):
@@ -16,6 +58,224 @@ class Modification(object):
         self.start_end_table = start_end_table
 
 
+class TabixRegionReader(object):
+    """
+    Region access to a bgzip compressed and tabix indexed file using pysam
+
+    The file is opened once and the handle is reused for every window,
+    rows are fetched in-process and parsed with explicit dtypes
+    """
+
+    def __init__(self, filename, header=False):
+        import pysam
+
+        self.filename = filename
+        self.handle = pysam.TabixFile(filename)
+        self.contigs = set(self.handle.contigs)
+        if header:
+            # tabix only keeps lines starting with the meta character as header
+            import gzip
+
+            with gzip.open(filename, "rt") as f:
+                self.names = f.readline().rstrip().split("\t")
+        else:
+            self.names = None
+
+    def fetch(self, window, zerobased=False):
+        """
+        Return the raw lines overlapping window,
+        using the same (1-based, inclusive) coordinates as the tabix command line
+
+        With zerobased the positions of window are taken as 0-based and inclusive,
+        as for the single-position records of nanocompore
+        """
+        chromosome = str(window.chromosome)
+        if chromosome not in self.contigs:
+            return iter(())
+        if zerobased:
+            return self.handle.fetch(chromosome, window.begin, window.end + 1)
+        return self.handle.fetch(chromosome, max(window.begin - 1, 0), window.end)
+
+    def read_region(self, window, names=None, usecols=None, dtype=None, zerobased=False):
+        return pd.read_csv(
+            StringIO("\n".join(self.fetch(window, zerobased=zerobased))),
+            sep="\t",
+            header=None,
+            names=names or self.names,
+            usecols=usecols,
+            dtype=dtype,
+        )
+
+
+def tabix_reader(filename, header=False):
+    """Return a TabixRegionReader for filename, opening every file only once per process"""
+    if filename not in _tabix_readers:
+        logging.info(f"Opening {filename} with pysam.TabixFile.")
+        _tabix_readers[filename] = TabixRegionReader(filename, header=header)
+    return _tabix_readers[filename]
+
+
+def select_window(table, window, chromosome="Chromosome", start="Start", end="End"):
+    """
+    Return the records of table overlapping window, sorted by start position
+
+    Equivalent to slicing a PyRanges object (start < window.end and end > window.begin),
+    using a binary search on the sorted start positions
+    The lower bound of the search is widened by the longest record of the table
+    """
+    on_chromosome = (table[chromosome].astype(str) == str(window.chromosome)).to_numpy()
+    if not on_chromosome.all():
+        table = table[on_chromosome]
+    starts = table[start].to_numpy()
+    ends = table[end].to_numpy()
+    if len(starts) == 0:
+        return table.reset_index(drop=True)
+    order = None
+    if np.any(starts[1:] < starts[:-1]):
+        order = np.argsort(starts, kind="stable")
+        starts, ends = starts[order], ends[order]
+    longest = np.max(ends - starts)
+    first = np.searchsorted(starts, window.begin - longest, side="right")
+    last = np.searchsorted(starts, window.end, side="left")
+    rows = first + np.flatnonzero(ends[first:last] > window.begin)
+    if order is not None:
+        rows = order[rows]
+    return table.iloc[rows].reset_index(drop=True)
+
+
+class PreloadedRegions(object):
+    """
+    Records of an unindexed file overlapping any of the windows of a batch run
+
+    The records are kept per chromosome sorted by start position,
+    so that the records of a window are found by a binary search
+    """
+
+    def __init__(self, table, chromosome, start, end):
+        self.empty = table.iloc[:0]
+        self.tables = {}
+        for name, sub in table.groupby(chromosome, sort=False):
+            sub = sub.sort_values(start, kind="stable")
+            starts = sub[start].to_numpy()
+            ends = sub[end].to_numpy()
+            self.tables[name] = (sub, starts, ends, np.max(ends - starts))
+
+    def read_region(self, window):
+        """Return the records overlapping window (inclusive coordinates, as read_unindexed)"""
+        if str(window.chromosome) not in self.tables:
+            return self.empty
+        sub, starts, ends, longest = self.tables[str(window.chromosome)]
+        first = np.searchsorted(starts, window.begin - longest, side="left")
+        last = np.searchsorted(starts, window.end, side="right")
+        return sub.iloc[first + np.flatnonzero(ends[first:last] >= window.begin)]
+
+
+def set_batch_windows(windows):
+    """
+    Declare the windows of a batch run
+
+    Inputs without tabix index are then read once for all windows instead of once per window
+    """
+    _batch_windows[:] = windows
+    _preloaded.clear()
+
+
+def preload_unindexed(filename, windows, chromosome, start, end, chunksize=100000, **kwargs):
+    """
+    Read the records of a file without tabix index which overlap any of windows
+
+    The file is parsed in chunks in a single pass.
+    Per chromosome the windows are merged to sorted disjoint intervals,
+    to which the records are matched using a binary search
+    """
+    intervals = {}
+    for window in sorted(windows, key=lambda w: w.begin):
+        merged = intervals.setdefault(str(window.chromosome), [])
+        if merged and window.begin <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], window.end)
+        else:
+            merged.append([window.begin, window.end])
+    intervals = {c: np.array(merged).T for c, merged in intervals.items()}
+    logging.info(f"Reading {filename} once for {len(windows)} windows.")
+    dtype = dict(kwargs.pop("dtype", None) or {})
+    dtype[chromosome] = str
+    reader = pd.read_csv(filename, sep="\t", chunksize=chunksize, dtype=dtype, **kwargs)
+    selected = []
+    for chunk in reader:
+        keep = np.zeros(len(chunk), dtype=bool)
+        for name, rows in chunk.groupby(chromosome, sort=False).indices.items():
+            if name not in intervals:
+                continue
+            begins, ends = intervals[name]
+            starts = chunk[start].to_numpy()[rows]
+            # the first interval ending at or after the start of the record
+            candidate = np.searchsorted(ends, starts, side="left")
+            overlapping = candidate < len(ends)
+            overlapping[overlapping] = (
+                begins[candidate[overlapping]] <= chunk[end].to_numpy()[rows][overlapping]
+            )
+            keep[rows[overlapping]] = True
+        selected.append(chunk[keep])
+    reader.close()
+    return PreloadedRegions(pd.concat(selected), chromosome, start, end)
+
+
+def compact_read_table(table):
+    """
+    Convert a per read table to compact dtypes
+
+    categorical read names, int8 strand (1 for +, -1 for -), int32 positions
+    and float32 log likelihood ratios (nanopolish) or uint8 qualities (cram) are used
+    """
+    table = table.assign(
+        read_name=table["read_name"].astype("category"),
+        strand=np.where(table["strand"] == "-", -1, 1).astype(np.int8),
+        pos=table["pos"].astype(np.int32),
+    )
+    if "log_lik_ratio" in table:
+        table["log_lik_ratio"] = table["log_lik_ratio"].astype(np.float32)
+    if "quality" in table:
+        table["quality"] = table["quality"].astype(np.uint8)
+    return table
+
+
+def read_unindexed(filename, window, chromosome, start, end, chunksize=100000, **kwargs):
+    """
+    Read the records of a file without tabix index which overlap window
+
+    :param chromosome, start, end: the columns with the coordinates of the records
+    other keyword arguments (e.g. usecols, dtype) are passed to pd.read_csv
+
+    The file is parsed in chunks, which are filtered on chromosome and position.
+    The whole file is always read, as the records of a chromosome don't have to be
+    contiguous or sorted (e.g. nanopolish output is in the order of the reads)
+
+    In a batch run (see set_batch_windows) the file is read only once for all windows
+    """
+    if _batch_windows:
+        if filename not in _preloaded:
+            _preloaded[filename] = preload_unindexed(
+                filename, _batch_windows, chromosome, start, end, chunksize=chunksize, **kwargs
+            )
+        return _preloaded[filename].read_region(window)
+    target = str(window.chromosome)
+    dtype = dict(kwargs.pop("dtype", None) or {})
+    dtype[chromosome] = str
+    reader = pd.read_csv(filename, sep="\t", chunksize=chunksize, dtype=dtype, **kwargs)
+    selected = []
+    for chunk in reader:
+        on_chromosome = chunk[(chunk[chromosome] == target).to_numpy()]
+        if len(on_chromosome):
+            selected.append(
+                on_chromosome[
+                    (on_chromosome[start] <= window.end) & (on_chromosome[end] >= window.begin)
+                ]
+            )
+    reader.close()
+    # without overlapping records an empty table with the same columns is returned
+    return pd.concat(selected) if selected else chunk.iloc[:0]
+
+
 def get_data(args, window):
     """
     Import methylation data from all files in the list methylation_files
@@ -30,10 +290,69 @@ def get_data(args, window):
 
     data is extracted within the window args.window
     Frequencies are smoothened using a sliding window
+    With args.threads > 1 the files are parsed concurrently in a process pool
     """
+    if args.threads > 1 and len(args.methylation) > 1:
+        return flatten(read_mods_parallel(args, window))
     return flatten([read_mods(f, n, window, args) for f, n in zip(args.methylation, args.names)])
 
 
+def read_mods_parallel(args, window):
+    """
+    Run read_mods for every file/name pair in a process pool
+
+    Every file is always read by the same worker process (see worker_pool)
+    Results are returned in the order of args.methylation
+    Errors are collected for all files and reported together
+    """
+    workers = worker_pool(min(args.threads, len(args.methylation)))
+    logging.info(f"Reading {len(args.methylation)} files using {len(workers)} processes.")
+    futures = [
+        workers[i % len(workers)].submit(read_mods, f, n, window, args)
+        for i, (f, n) in enumerate(zip(args.methylation, args.names))
+    ]
+    results = []
+    errors = []
+    for filename, future in zip(args.methylation, futures):
+        try:
+            results.append(future.result())
+        except SystemExit as e:
+            errors.append(f"{filename}: {e.code}")
+        except Exception as e:
+            errors.append(f"{filename}: {type(e).__name__}: {e}")
+    if errors:
+        for error in errors:
+            logging.error(f"Error processing {error}")
+        sys.exit("\n\n\nERROR processing the following file(s):\n" + "\n".join(errors) + "\n")
+    return results
+
+
+def worker_pool(workers):
+    """
+    Return a list of single process executors, created once and reused for every window
+
+    Pinning every file to one process keeps its open tabix handle
+    and the records preloaded for a batch run (see set_batch_windows) in that process
+    """
+    from concurrent.futures import ProcessPoolExecutor
+
+    if len(_workers) != workers:
+        shutdown_workers()
+        _workers.extend(
+            ProcessPoolExecutor(
+                max_workers=1, initializer=set_batch_windows, initargs=(list(_batch_windows),)
+            )
+            for _ in range(workers)
+        )
+    return _workers
+
+
+def shutdown_workers():
+    for executor in _workers:
+        executor.shutdown()
+    _workers.clear()
+
+
 def read_mods(filename, name, window, args):
     """
     converts a file from nanopolish to a pandas dataframe
@@ -43,16 +362,44 @@ def read_mods(filename, name, window, args):
 
     input can also be raw data per read, optionally phased
     which will return a dataframe with 'read', 'chromosome', 'pos', 'log_lik_ratio', 'strand'
+
+    if args.cache is set, the parsed data is looked up in and added to the cache
     """
-    file_type = file_sniffer(filename)
-    logging.info(f"File {filename} is of type {file_type}")
+    if args.cache:
+        from methplotlib import cache
+
+        key = cache.cache_key(filename, window, args)
+        cached = cache.load(args.cache, key, name)
+        if cached is not None:
+            logging.info(f"Loaded {filename} for {window.string} from the cache.")
+            return cached
+        mods = parse_mods(filename, name, window, args)
+        cache.store(args.cache, key, name, mods, max_size=args.cache_size)
+        return mods
+    return parse_mods(filename, name, window, args)
+
+
+def parse_mods(filename, name, window, args):
+    """Sniff the type of filename and parse the data in window accordingly"""
+    if filename not in _file_types:
+        _file_types[filename] = file_sniffer(filename)
+        logging.info(f"File {filename} is of type {_file_types[filename]}")
+    file_type = _file_types[filename]
     try:
         if file_type.startswith("nanopolish"):
-            return parse_nanopolish(filename, file_type, name, window, smoothen=args.smoothen)
+            return parse_nanopolish(filename, file_type, name, window, smoothen=args.smooth)
         elif file_type == "nanocompore":
             return [parse_nanocompore(filename, name, window)]
         elif file_type in ["cram", "bam"]:
-            return parse_cram(filename, file_type, name, window, args.mods)
+            return parse_cram(
+                filename,
+                file_type,
+                name,
+                window,
+                args.mods,
+                threads=args.threads,
+                shard_size=args.shard_size,
+            )
         elif file_type == "bedgraph":
             return [parse_bedgraph(filename, name, window)]
         elif file_type == "bedmethyl_extended":
@@ -72,81 +419,61 @@ def parse_nanopolish(filename, file_type, name, window, smoothen=5):
         from pathlib import Path
 
         if Path(filename + ".tbi").is_file():
-            import subprocess
-            import gzip
-
-            logging.info(f"Reading {filename} using a tabix stream.")
-            region = f"{window.chromosome}:{window.begin}-{window.end}"
-            try:
-                tabix_stream = subprocess.Popen(
-                    ["tabix", filename, region],
-                    stdout=subprocess.PIPE,
-                    stderr=subprocess.PIPE,
-                )
-            except FileNotFoundError as e:
-                logging.error("Error when opening a tabix stream.")
-                logging.error(e, exc_info=True)
-                sys.stderr.write("\n\nERROR when opening a tabix stream.\n")
-                sys.stderr.write("Is tabix installed and on the PATH?.")
-                raise
-            header = gzip.open(filename, "rt").readline().rstrip().split("\t")
-            table = pd.read_csv(tabix_stream.stdout, sep="\t", header=None, names=header)
+            logging.info(f"Reading {filename} using tabix.")
+            table = tabix_reader(filename, header=True).read_region(
+                window, usecols=lambda c: c not in NANOPOLISH_UNUSED, dtype=NANOPOLISH_DTYPES
+            )
         else:
             logging.info(f"Reading {filename} slowly by splitting the file in chunks.")
             sys.stderr.write(f"\nReading {filename} would be faster with bgzip and tabix.\n")
             if file_type in ["nanopolish_call", "nanopolish_phased"]:
-                sys.stderr.write("Please index with 'tabix -S1 -s1 -b3 -e4'.\n")
+                sys.stderr.write("Please index with 'tabix -S1 -s1 -b3 -e4'")
             else:
-                sys.stderr.write("Please index with 'tabix -S1 -s1 -b2 -e3'.\n")
-            iter_csv = pd.read_csv(filename, sep="\t", iterator=True, chunksize=1e6)
-            table = pd.concat(
-                [chunk[chunk["chromosome"] == window.chromosome] for chunk in iter_csv]
+                sys.stderr.write("Please index with 'tabix -S1 -s1 -b2 -e3'")
+            sys.stderr.write(f", 'methplotlib index {filename}' or use --auto-index.\n")
+            table = read_unindexed(
+                filename,
+                window,
+                chromosome="chromosome",
+                start="start",
+                end="end",
+                usecols=lambda c: c not in NANOPOLISH_UNUSED,
+                dtype=NANOPOLISH_DTYPES,
             )
     else:
-        table = pd.read_csv(filename, sep="\t")
-    gr = pr.PyRanges(
-        table.rename(
-            columns={
-                "start": "Start",
-                "chromosome": "Chromosome",
-                "end": "End",
-                "Strand": "strand",
-            }
+        table = pd.read_csv(
+            filename, sep="\t", usecols=lambda c: c not in NANOPOLISH_UNUSED, dtype=NANOPOLISH_DTYPES
         )
+    table = table.rename(
+        columns={
+            "start": "Start",
+            "chromosome": "Chromosome",
+            "end": "End",
+            "Strand": "strand",
+        }
     )
     logging.info("Read the file in a dataframe.")
 
     if window:
-        gr = gr[str(window.chromosome), window.begin : window.end]
-    try:
-        gr.pos = np.floor(gr.drop().df[["Start", "End"]].mean(axis=1))
-    except KeyError:
+        table = select_window(table, window)
+    if table.empty:
         sys.stderr.write(f"\n\n\nProblem parsing nanopolish file {filename}!\n")
-        sys.stderr.write(
-            "Could it be that there are no calls in your selected window "
-            f"{window.chromosome}:{window.begin}-{window.end}?\n"
-        )
-        sys.stderr.write("\n\n\nDetailed error:\n")
-        raise
-
-    table = gr.df
+        if window:
+            sys.stderr.write(
+                "Could it be that there are no calls in your selected window "
+                f"{window.chromosome}:{window.begin}-{window.end}?\n"
+            )
+        sys.exit(f"No records for {filename}!\n")
+    table["pos"] = (table["Start"] + table["End"]) // 2
 
     if file_type in ["nanopolish_call", "nanopolish_phased"]:
-        table = table.drop(
-            columns=[
-                "Start",
-                "End",
-                "log_lik_methylated",
-                "log_lik_unmethylated",
-                "num_calling_strands",
-                "num_motifs",
-                "sequence",
-            ]
-        )
+        table = compact_read_table(table.drop(columns=["Start", "End"]))
         if "motif" in table:
             return [
                 Modification(
-                    table=sub_df,
+                    table=sub_df.assign(
+                        read_name=sub_df["read_name"].cat.remove_unused_categories()
+                    ),
                     data_type=file_type,
                     name=f"{name}_{mod}",
                     called_sites=len(sub_df),
@@ -166,17 +493,7 @@ def parse_nanopolish(filename, file_type, name, window, smoothen=5):
         called_sites = table.called_sites
         chromosome = table.Chromosome.values[0]
 
-        table = table.drop(
-            columns=[
-                "Chromosome",
-                "Start",
-                "End",
-                "num_motifs_in_group",
-                "called_sites",
-                "called_sites_methylated",
-                "group_sequence",
-            ]
-        )
+        table = table.drop(columns=["Chromosome", "Start", "End", "called_sites"])
         return [
             Modification(
                 table=table.sort_values("pos")
@@ -201,12 +518,38 @@ def parse_nanocompore(filename, name, window):
         else:
             return False
 
-    table = pd.read_csv(filename, sep="\t", usecols=nanocompore_columns_of_interest)
+    dtype = {"ref_id": str, "pos": np.int64}
     if window:
-        table = table[table["ref_id"] == window.chromosome]
+        from pathlib import Path
+
+        if Path(filename + ".tbi").is_file():
+            logging.info(f"Reading {filename} using tabix.")
+            table = tabix_reader(filename, header=True).read_region(
+                window, usecols=nanocompore_columns_of_interest, dtype=dtype, zerobased=True
+            )
+        else:
+            logging.info(f"Reading {filename} slowly by splitting the file in chunks.")
+            sys.stderr.write(
+                f"\nReading {filename} would be faster when sorted, bgzip compressed and indexed.\n"
+                f"Please index with 'methplotlib index {filename}' or use --auto-index.\n"
+            )
+            table = read_unindexed(
+                filename,
+                window,
+                chromosome="ref_id",
+                start="pos",
+                end="pos",
+                usecols=nanocompore_columns_of_interest,
+                dtype=dtype,
+            )
+    else:
+        table = pd.read_csv(
+            filename, sep="\t", usecols=nanocompore_columns_of_interest, dtype=dtype
+        )
     return Modification(
-        table=table.sort_values("pos")
-        .append({"pos": window.end}, ignore_index=True)
+        table=pd.concat(
+            [table.sort_values("pos"), pd.DataFrame({"pos": [window.end]})], ignore_index=True
+        )
         .drop(columns="ref_id")
         .fillna(1.0),
         data_type="nanocompore",
@@ -220,43 +563,27 @@ def parse_bedgraph(filename, name, window):
         from pathlib import Path
 
         if Path(filename + ".tbi").is_file():
-            import subprocess
-
-            logging.info(f"Reading {filename} using a tabix stream.")
-            region = f"{window.chromosome}:{window.begin}-{window.end}"
-            try:
-                tabix_stream = subprocess.Popen(
-                    ["tabix", filename, region],
-                    stdout=subprocess.PIPE,
-                    stderr=subprocess.PIPE,
-                )
-            except FileNotFoundError as e:
-                logging.error("Error when opening a tabix stream.")
-                logging.error(e, exc_info=True)
-                sys.stderr.write("\n\nERROR when opening a tabix stream.\n")
-                sys.stderr.write("Is tabix installed and on the PATH?.")
-                raise
-            table = pd.read_csv(
-                tabix_stream.stdout,
-                sep="\t",
-                header=None,
+            logging.info(f"Reading {filename} using tabix.")
+            table = tabix_reader(filename).read_region(
+                window,
                 names=["Chromosome", "Start", "End", "Value"],
+                dtype=BEDGRAPH_DTYPES,
             )
         else:
             logging.info(f"Reading {filename} slowly by splitting the file in chunks.")
             sys.stderr.write(
                 f"\nReading {filename} would be faster with bgzip and 'tabix -p bed'.\n"
+                f"Please index with 'methplotlib index {filename}' or use --auto-index.\n"
             )
-            iter_csv = pd.read_csv(
+            table = read_unindexed(
                 filename,
-                sep="\t",
-                iterator=True,
-                chunksize=1e6,
+                window,
+                chromosome="Chromosome",
+                start="Start",
+                end="End",
                 header=None,
                 names=["Chromosome", "Start", "End", "Value"],
-            )
-            table = pd.concat(
-                [chunk[chunk["Chromosome"] == window.chromosome] for chunk in iter_csv]
+                dtype=BEDGRAPH_DTYPES,
             )
     else:
         table = pd.read_csv(
@@ -264,18 +591,19 @@ def parse_bedgraph(filename, name, window):
             sep="\t",
             header=None,
             names=["Chromosome", "Start", "End", "Value"],
+            dtype=BEDGRAPH_DTYPES,
         )
-    gr = pr.PyRanges(table)
     logging.info("Read the file in a dataframe.")
+    called_sites = len(table)
     if window:
-        gr = gr[window.chromosome, window.begin : window.end]
-        if len(gr.df) == 0:
+        table = select_window(table, window)
+        if len(table) == 0:
             sys.exit(f"No records for {filename} in {window.string}!\n")
     return Modification(
-        table=gr.df.sort_values("Start"),
+        table=table.sort_values("Start"),
         data_type="bedgraph",
         name=name,
-        called_sites=len(table),
+        called_sites=called_sites,
     )
 
 
@@ -299,63 +627,53 @@ def parse_bedmethyl(filename, name, window, smoothen=5, flavor="modkit", mods_of
             11: "canonical",
             12: "modified",
         }
+    ncols = 18 if flavor == "modkit" else 14
     usecols = colnames.keys()
     if window:
         from pathlib import Path
 
         if Path(filename + ".tbi").is_file():
-            import subprocess
-
-            logging.info(f"Reading {filename} using a tabix stream.")
-            region = f"{window.chromosome}:{window.begin}-{window.end}"
-            try:
-                tabix_stream = subprocess.Popen(
-                    ["tabix", filename, region],
-                    stdout=subprocess.PIPE,
-                    stderr=subprocess.PIPE,
+            logging.info(f"Reading {filename} using tabix.")
+            table = (
+                tabix_reader(filename)
+                .read_region(
+                    window,
+                    names=list(range(ncols)),
+                    usecols=usecols,
+                    dtype=BEDMETHYL_DTYPES,
                 )
-            except FileNotFoundError as e:
-                logging.error("Error when opening a tabix stream.")
-                logging.error(e, exc_info=True)
-                sys.stderr.write("\n\nERROR when opening a tabix stream.\n")
-                sys.stderr.write("Is tabix installed and on the PATH?.")
-                raise
-            table = pd.read_csv(
-                tabix_stream.stdout,
-                sep="\t",
-                header=None,
-                usecols=usecols,
-            ).rename(columns=colnames)
+                .rename(columns=colnames)
+            )
         else:
             logging.info(f"Reading {filename} slowly by splitting the file in chunks.")
             sys.stderr.write(
                 f"\nReading {filename} would be faster with bgzip and 'tabix -p bed'.\n"
+                f"Please index with 'methplotlib index {filename}' or use --auto-index.\n"
             )
-            iter_csv = pd.read_csv(
+            table = read_unindexed(
                 filename,
-                sep="\t",
-                iterator=True,
-                chunksize=1e6,
+                window,
+                chromosome=0,
+                start=1,
+                end=2,
                 header=None,
                 usecols=usecols,
-            )
-            table = pd.concat([chunk[chunk[0] == window.chromosome] for chunk in iter_csv]).rename(
-                columns=colnames
-            )
+                dtype=BEDMETHYL_DTYPES,
+            ).rename(columns=colnames)
     else:
         table = pd.read_csv(
             filename,
             sep="\t",
             header=None,
             usecols=usecols,
+            dtype=BEDMETHYL_DTYPES,
         ).rename(columns=colnames)
-    gr = pr.PyRanges(table)
     logging.info("Read the file in a dataframe.")
     if window:
-        gr = gr[window.chromosome, window.begin : window.end]
-        if len(gr.df) == 0:
+        table = select_window(table, window)
+        if len(table) == 0:
             sys.exit(f"No records for {filename} in {window.string}!\n")
-    table = gr.df.sort_values("Start")
+    table = table.sort_values("Start")
     if flavor == "modkit":
         table["modified_frequency"] = table["Frequency"] / 100
         table.drop(columns=["Frequency"], inplace=True)
@@ -381,7 +699,9 @@ def parse_bedmethyl(filename, name, window, smoothen=5, flavor="modkit", mods_of
     ]
 
 
-def parse_cram(filename, filetype, name, window, mods_of_interest=None):
+def parse_cram(
+    filename, filetype, name, window, mods_of_interest=None, threads=1, shard_size=None
+):
     """
     Extracts modified positions from a CRAM file
 
@@ -390,109 +710,272 @@ def parse_cram(filename, filetype, name, window, mods_of_interest=None):
     :param name: str, name for the trace/sample
     :param window: Region object to extract data for from the file
     :param mods_of_interest: list of str, optional, list of modifications to extract
+    :param threads: int, number of htslib decompression threads,
+                    or number of processes when the window is sharded
+    :param shard_size: int, optional, split windows larger than this in shards
+                       which are extracted in parallel by threads processes
     """
-    import pysam
-
     mode = "rc" if filetype == "cram" else "rb"
-    cram = pysam.AlignmentFile(filename, mode)
-    data = []
-    start_stops = []
-    for read in cram.fetch(reference=str(window.chromosome), start=window.begin, end=window.end):
-        if not read.is_supplementary and not read.is_secondary:
-            start_stops.append((read.query_name, read.reference_start, read.reference_end))
-            mod_positions = get_modified_reference_positions(read)
-            if mod_positions:
-                data.extend(mod_positions)
-    df = (
-        pd.DataFrame(data, columns=["read_name", "strand", "pos", "quality", "mod"])
-        .astype(dtype={"mod": "category", "quality": "float"})
-        .sort_values(["read_name", "pos"])
-    )
-
+    if shard_size and threads > 1 and window.size > shard_size:
+        from concurrent.futures import ProcessPoolExecutor
+
+        shards = split_region(window, shard_size)
+        logging.info(f"Extracting {filename} in {len(shards)} shards of {window.string}.")
+        with ProcessPoolExecutor(max_workers=min(threads, len(shards))) as executor:
+            # every read is only reported by the shard in which it starts,
+            # or by the first shard if it starts before the window
+            results = list(
+                executor.map(
+                    extract_modified_bases,
+                    [filename] * len(shards),
+                    [mode] * len(shards),
+                    shards,
+                    [1] * len(shards),
+                    [None] + [shard.begin for shard in shards[1:]],
+                )
+            )
+    else:
+        results = [extract_modified_bases(filename, mode, window, threads=threads)]
+    columns, start_stops, mods = merge_extractions(results)
+    read_names = np.array([s[0] for s in start_stops], dtype=object)
+    df = pd.DataFrame(
+        {
+            "read_name": pd.Categorical(read_names[columns["read_index"]]),
+            "strand": np.where(columns["reverse"], -1, 1).astype(np.int8),
+            "pos": columns["pos"].astype(np.int32),
+            "quality": columns["quality"].astype(np.uint8),
+            "mod": pd.Categorical.from_codes(columns["mod"], categories=mods),
+        }
+    ).sort_values(["read_name", "pos"])
 
     if mods_of_interest:
         mods_found = df["mod"].unique().categories.values
         df = df[df["mod"].isin(mods_of_interest.split(","))]
         if len(df) == 0:
             sys.exit(f"No more records after selecting --mods!\nDetected modifications: {mods_found}\n")
+    start_end_table = (
+        pd.DataFrame(start_stops, columns=["read_name", "posmin", "posmax"])
+        .drop_duplicates(subset="read_name")
+        .set_index("read_name")
+    )
     return [
         Modification(
-            table=sub_df,
+            table=sub_df.assign(read_name=sub_df["read_name"].cat.remove_unused_categories()),
             data_type="ont-cram",
             name=f"{name}_{mod}",
             called_sites=len(sub_df),
-            start_end_table=pd.DataFrame(
-                start_stops, columns=["read_name", "posmin", "posmax"]
-            ).set_index("read_name"),
+            start_end_table=start_end_table,
         )
-        for mod, sub_df in df.groupby("mod") if len(sub_df) > 0
+        for mod, sub_df in df.groupby("mod", observed=True) if len(sub_df) > 0
+    ]
+
+
+def split_region(window, shard_size):
+    """Split the Region window in consecutive shards of at most shard_size"""
+    from methplotlib.utils import Region
+
+    return [
+        Region(f"{window.chromosome}:{begin}-{min(begin + shard_size, window.end)}")
+        for begin in range(window.begin, window.end, shard_size)
     ]
 
 
-def get_modified_reference_positions(read):
-    mod_positions = []
-    if read.has_tag("Mm") or read.has_tag("MM"):
-        modtag = "Mm" if read.has_tag("Mm") else "MM"
-        qualtag = "Ml" if read.has_tag("Ml") else "ML"
+def extract_modified_bases(filename, mode, window, threads=1, owned_from=None, chunksize=1000):
+    """
+    Extract the modified bases of the primary alignments overlapping window
+
+    :param owned_from: int, optional, only report reads starting at or after this position
+    Returns the columns from decode_modified_bases, a list of (read_name, start, end) tuples
+    to which the read_index column refers, and the list of modifications the mod codes refer to
+    """
+    cram = alignment_file(filename, mode, threads=threads)
+    mod_codes = {}
+    chunks = []
+    reads = []
+    start_stops = []
+    for read in cram.fetch(reference=str(window.chromosome), start=window.begin, end=window.end):
+        if read.is_supplementary or read.is_secondary:
+            continue
+        if owned_from is not None and read.reference_start < owned_from:
+            continue
+        start_stops.append((read.query_name, read.reference_start, read.reference_end))
+        reads.append(read)
+        if len(reads) == chunksize:
+            chunks.append(decode_modified_bases(reads, mod_codes, len(start_stops) - len(reads)))
+            reads = []
+    if reads:
+        chunks.append(decode_modified_bases(reads, mod_codes, len(start_stops) - len(reads)))
+    columns = {
+        key: np.concatenate([c[key] for c in chunks]) if chunks else np.empty(0, dtype=np.int64)
+        for key in ["read_index", "reverse", "pos", "quality", "mod"]
+    }
+    return columns, start_stops, list(mod_codes)
+
+
+def alignment_file(filename, mode, threads=1):
+    """
+    Return a pysam.AlignmentFile for filename, opening every file only once per process
+
+    The process id is part of the key, as a handle inherited by a forked process
+    shares its file offset with the parent and can't be used concurrently
+    """
+    import os
+    import pysam
+
+    key = (filename, mode, threads, os.getpid())
+    if key not in _alignment_files:
+        logging.info(f"Opening {filename} with pysam.AlignmentFile.")
+        _alignment_files[key] = pysam.AlignmentFile(filename, mode, threads=threads)
+    return _alignment_files[key]
+
+
+def merge_extractions(results):
+    """
+    Combine the output of extract_modified_bases for multiple shards
+
+    read indices are offset to the concatenated list of reads
+    and modification codes are translated to a shared list of modifications
+    """
+    if len(results) == 1:
+        return results[0]
+    mods = list(dict.fromkeys(mod for _, _, shard_mods in results for mod in shard_mods))
+    merged = {key: [] for key in ["read_index", "reverse", "pos", "quality", "mod"]}
+    start_stops = []
+    for columns, shard_start_stops, shard_mods in results:
+        translate = np.array([mods.index(mod) for mod in shard_mods], dtype=np.int64)
+        for key, values in columns.items():
+            if key == "read_index":
+                values = values + len(start_stops)
+            elif key == "mod" and len(values):
+                values = translate[values]
+            merged[key].append(values)
+        start_stops.extend(shard_start_stops)
+    return {key: np.concatenate(values) for key, values in merged.items()}, start_stops, mods
+
+
+COMPLEMENT = np.arange(256, dtype=np.uint8)
+COMPLEMENT[np.frombuffer(b"ACGTNacgtn", dtype=np.uint8)] = np.frombuffer(b"TGCANtgcan", dtype=np.uint8)
+QUERY_CONSUMING = [0, 1, 4, 7, 8]
+REFERENCE_CONSUMING = [0, 2, 3, 7, 8]
+ALIGNED = [0, 7, 8]
+
+
+def query_to_reference_positions(read):
+    """
+    Return an array with for every base of the read in sequencing direction
+    the reference position it is aligned to, or -1 for soft clipped and inserted bases
+
+    This is the equivalent of read.get_reference_positions(full_length=True)
+    built from the cigar operations rather than per base
+    """
+    cigar = np.array(read.cigartuples, dtype=np.int64).reshape(-1, 2)
+    ops, lengths = cigar[:, 0], cigar[:, 1]
+    query_lengths = np.where(np.isin(ops, QUERY_CONSUMING), lengths, 0)
+    reference_lengths = np.where(np.isin(ops, REFERENCE_CONSUMING), lengths, 0)
+    query_starts = np.cumsum(query_lengths) - query_lengths
+    reference_starts = read.reference_start + np.cumsum(reference_lengths) - reference_lengths
+    aligned = np.isin(ops, ALIGNED)
+    block_lengths = lengths[aligned]
+    within_block = np.arange(block_lengths.sum()) - np.repeat(
+        np.cumsum(block_lengths) - block_lengths, block_lengths
+    )
+    refpos = np.full(query_lengths.sum(), -1, dtype=np.int64)
+    refpos[np.repeat(query_starts[aligned], block_lengths) + within_block] = (
+        np.repeat(reference_starts[aligned], block_lengths) + within_block
+    )
+    # the MM/ML tags are specified in the direction the read came from the sequencer
+    return refpos[::-1] if read.is_reverse else refpos
+
+
+def decode_modified_bases(reads, mod_codes, first_index=0):
+    """
+    Decode the MM/ML tags of a chunk of reads into NumPy column arrays
+
+    :param reads: list of pysam.AlignedSegment objects
+    :param mod_codes: dict mapping modification (e.g. C+m) to an integer code,
+                      extended with newly encountered modifications
+    :param first_index: int, read index of the first read in the chunk
+    Returns a dict with arrays for read_index, reverse, pos, quality and mod (code)
+    Modified bases which are not aligned to the reference (soft clips, insertions) are dropped
+    """
+    read_index, reverse, positions, qualities, mods = [], [], [], [], []
+    for index, read in enumerate(reads, start=first_index):
+        if read.has_tag("MM"):
+            modtag, qualtag = "MM", "ML"
+        elif read.has_tag("Mm"):
+            modtag, qualtag = "Mm", "Ml"
+        else:
+            continue
+        sequence = read.query_sequence
+        if not sequence:
+            continue
+        # get_forward_sequence() as a uint8 array, without creating a new string
+        forward = np.frombuffer(sequence.encode(), dtype=np.uint8)
+        if read.is_reverse:
+            forward = COMPLEMENT[forward[::-1]]
+        refpos = query_to_reference_positions(read)
+        # The likelihoods are in an array of length of all Mm/MM deltas,
+        # and are not separated by context/modified nucleotide type
+        likelihoods = (
+            np.asarray(read.get_tag(qualtag), dtype=np.uint8) if read.has_tag(qualtag) else None
+        )
         offset = 0
         for context in read.get_tag(modtag).split(";"):
-            if context:
-                basemod = context.split(",", 1)[0].replace('?', '')
-                if "-" in basemod:
-                    sys.exit(
-                        "ERROR: modifications on negative strand currently unsupported.\n"
-                        "Please contact me if this would be of interest for you."
-                    )
-                base, mod = basemod.split("+")
-                # code below does not work with for ambiguous N and will search for a literal N
-                if base == "N":
-                    sys.exit(
-                        "ERROR: modifications of N nucleotides currently unsupported.\n"
-                        "Please contact me if this would be of interest for you."
-                    )
-                # The positions are encoded by specifying the number of non-modified occurences
-                # of that specific bases to skip in the read sequence
-                deltas = [int(i) for i in context.split(",")[1:]]
-                if not deltas:
-                    continue
-                # Make an array with all positions for which a modification is reported
-                # In coordinates relative to occurences of the nucleotide in the read
-                locations = np.cumsum(deltas) + np.arange(len(deltas))
-                # Nake an array with all read positions for which that nucleotide exists in the read
-                # Oddly, get_forward_sequence() returns the sequence as it came from the sequencer
-                # This is the same direction as the Mm/Ml tags are specified in
-                base_index = np.array(
-                    [i for i, letter in enumerate(read.get_forward_sequence()) if letter == base]
+            if not context:
+                continue
+            basemod, *deltas = context.split(",")
+            basemod = basemod.rstrip("?.")
+            if "-" in basemod:
+                sys.exit(
+                    "ERROR: modifications on negative strand currently unsupported.\n"
+                    "Please contact me if this would be of interest for you."
                 )
-                # Based on both arrays, find those read coordinates that have a modification
-                modified_bases = base_index[locations]
-                # Convert the array of read coordinates to reference coordinates
-                # full_length=True will make sure the list is of the same length as the read
-                # by adding 'None' for softclipped nucleotides
-                refpos = np.array(read.get_reference_positions(full_length=True))
-                # read.get_reference_positions() returns incrementing coordinates
-                # regardless of strand, so reversing the order for reverse_stranded reads
-                if read.is_reverse:
-                    refpos = refpos[::-1]
-                # The likelihoods are in an array of length of all Mm/MM deltas,
-                # and are not separated by context/modified nucleotide type
-                if read.has_tag(qualtag):
-                    likelihoods = read.get_tag(qualtag).tolist()[offset : offset + len(deltas)]
-                else:
-                    likelihoods = [255] * len(deltas)
-                offset += len(deltas)
-                mod_positions.extend(
-                    zip(
-                        repeat(read.query_name),  # read_name
-                        repeat("-" if read.is_reverse else "+"),  # strand
-                        refpos[modified_bases],  # pos
-                        likelihoods,  # quality
-                        repeat(basemod),  # mod
-                    )
+            base, mod = basemod.split("+")
+            # code below does not work with for ambiguous N and will search for a literal N
+            if base == "N":
+                sys.exit(
+                    "ERROR: modifications of N nucleotides currently unsupported.\n"
+                    "Please contact me if this would be of interest for you."
                 )
-        return mod_positions
-    else:
-        return None
+            if not deltas:
+                continue
+            # The positions are encoded by specifying the number of non-modified occurences
+            # of that specific bases to skip in the read sequence
+            deltas = np.array(deltas, dtype=np.int64)
+            locations = np.cumsum(deltas) + np.arange(len(deltas))
+            base_index = np.flatnonzero(forward == ord(base))
+            # Convert the read coordinates to reference coordinates
+            pos = refpos[base_index[locations]]
+            # Multiple modification codes in one context (e.g. C+hm) have interleaved likelihoods
+            codes = [mod] if mod.isdigit() else list(mod)
+            for i, code in enumerate(codes):
+                key = f"{base}+{code}"
+                if likelihoods is None:
+                    quality = np.full(len(deltas), 255, dtype=np.uint8)
+                else:
+                    quality = likelihoods[offset + i : offset + len(deltas) * len(codes) : len(codes)]
+                keep = pos >= 0
+                read_index.append(np.full(keep.sum(), index, dtype=np.int64))
+                reverse.append(np.full(keep.sum(), read.is_reverse))
+                positions.append(pos[keep])
+                qualities.append(quality[keep])
+                mods.append(np.full(keep.sum(), mod_codes.setdefault(key, len(mod_codes))))
+            offset += len(deltas) * len(codes)
+    if not read_index:
+        return dict(
+            read_index=np.empty(0, dtype=np.int64),
+            reverse=np.empty(0, dtype=bool),
+            pos=np.empty(0, dtype=np.int64),
+            quality=np.empty(0, dtype=np.uint8),
+            mod=np.empty(0, dtype=np.int64),
+        )
+    return dict(
+        read_index=np.concatenate(read_index),
+        reverse=np.concatenate(reverse),
+        pos=np.concatenate(positions),
+        quality=np.concatenate(qualities),
+        mod=np.concatenate(mods),
+    )
 
 
 def errs_tab(n):
@@ -0,0 +1,228 @@
+from argparse import ArgumentParser
+from pathlib import Path
+import heapq
+import itertools
+import logging
+import sys
+import tempfile
+from methplotlib.utils import file_sniffer
+
+# tabix_index arguments (0-based columns) per file type, as in
+# 'tabix -S1 -s1 -b3 -e4', 'tabix -S1 -s1 -b2 -e3' and 'tabix -p bed'
+TABIX_SPECS = {
+    "nanopolish_call": dict(seq_col=0, start_col=2, end_col=3, line_skip=1),
+    "nanopolish_phased": dict(seq_col=0, start_col=2, end_col=3, line_skip=1),
+    "nanopolish_freq": dict(seq_col=0, start_col=1, end_col=2, line_skip=1),
+    "bedgraph": dict(seq_col=0, start_col=1, end_col=2, line_skip=0, zerobased=True),
+    "bedmethyl": dict(seq_col=0, start_col=1, end_col=2, line_skip=0, zerobased=True),
+    "bedmethyl_extended": dict(seq_col=0, start_col=1, end_col=2, line_skip=0, zerobased=True),
+}
+
+
+def tabix_spec(filename, file_type):
+    """
+    Return the tabix_index arguments for filename, or None if the type can't be indexed
+
+    For nanocompore results the columns ref_id and pos are located in the header
+    """
+    if file_type == "nanocompore":
+        with open_text(filename) as f:
+            header = f.readline().rstrip("\n").split("\t")
+        return dict(
+            seq_col=header.index("ref_id"),
+            start_col=header.index("pos"),
+            end_col=header.index("pos"),
+            line_skip=1,
+            zerobased=True,
+        )
+    return TABIX_SPECS.get(file_type)
+
+
+def main(argv=None):
+    args = get_args(argv)
+    for filename in args.files:
+        indexed = index_file(filename, outfile=args.outfile, chunk_lines=args.chunk_lines)
+        sys.stderr.write(f"Indexed {filename} as {indexed}\n")
+
+
+def get_args(argv=None):
+    parser = ArgumentParser(
+        prog="methplotlib index",
+        description="Sort, bgzip compress and index files for fast access to windows",
+    )
+    parser.add_argument("files", nargs="+", help="files to index")
+    parser.add_argument(
+        "-o",
+        "--outfile",
+        help="Name of the sorted and compressed output (only for a single file). "
+        "Default: the input with extension .sorted.gz, "
+        "or the input itself if it is already sorted and bgzip compressed",
+    )
+    parser.add_argument(
+        "--chunk-lines",
+        help="Number of lines to sort in memory at once",
+        type=int,
+        default=1000000,
+    )
+    args = parser.parse_args(argv)
+    if args.outfile and len(args.files) > 1:
+        sys.exit("INPUT ERROR: --outfile can only be used when indexing a single file!")
+    return args
+
+
+def indexed_path(filename):
+    """Name of the sorted and bgzip compressed copy of filename"""
+    base = filename[:-3] if filename.endswith(".gz") else filename
+    return base + ".sorted.gz"
+
+
+def ensure_indexed(filename):
+    """
+    Return the name of an indexed version of filename, creating it if required
+
+    Used by --auto-index, the indexed copy is reused as long as it is newer than filename
+    """
+    file_type = file_sniffer(filename)
+    if file_type in ["cram", "bam"]:
+        if not has_alignment_index(filename):
+            index_file(filename)
+        return filename
+    if tabix_spec(filename, file_type) is None or Path(filename + ".tbi").is_file():
+        return filename
+    indexed = Path(indexed_path(filename))
+    tbi = Path(str(indexed) + ".tbi")
+    if tbi.is_file() and tbi.stat().st_mtime >= Path(filename).stat().st_mtime:
+        return str(indexed)
+    sys.stderr.write(f"\nIndexing {filename}, which can take a while but only has to happen once.\n")
+    return index_file(filename)
+
+
+def has_alignment_index(filename):
+    import pysam
+
+    try:
+        with pysam.AlignmentFile(filename) as aln:
+            return aln.check_index()
+    except ValueError:
+        return False
+
+
+def index_file(filename, outfile=None, chunk_lines=1000000):
+    """
+    Sort (if required), bgzip compress and tabix index filename
+
+    bam and cram files are indexed with pysam.index, but not sorted
+    Returns the name of the indexed file
+    """
+    import pysam
+
+    file_type = file_sniffer(filename)
+    logging.info(f"Indexing {filename} of type {file_type}.")
+    if file_type in ["cram", "bam"]:
+        pysam.index(filename)
+        return filename
+    spec = tabix_spec(filename, file_type)
+    if spec is None:
+        sys.exit(f"ERROR: indexing files of type {file_type} is not supported.")
+    if outfile is None and is_bgzf(filename) and is_sorted(filename, spec):
+        outfile = filename
+    else:
+        outfile = outfile or indexed_path(filename)
+        sort_to_bgzf(filename, outfile, spec, chunk_lines=chunk_lines)
+    pysam.tabix_index(outfile, force=True, **spec)
+    return outfile
+
+
+def is_bgzf(filename):
+    """Check for the gzip magic number and the BC extra subfield of the bgzip format"""
+    with open(filename, "rb") as f:
+        head = f.read(16)
+    return (
+        len(head) == 16 and head[:2] == b"\x1f\x8b" and bool(head[3] & 4) and head[12:14] == b"BC"
+    )
+
+
+def open_text(filename):
+    import gzip
+
+    with open(filename, "rb") as f:
+        gzipped = f.read(2) == b"\x1f\x8b"
+    return gzip.open(filename, "rt") if gzipped else open(filename)
+
+
+def sort_key(spec):
+    seq_col, start_col = spec["seq_col"], spec["start_col"]
+
+    def key(line):
+        fields = line.split("\t", max(seq_col, start_col) + 1)
+        return fields[seq_col], int(fields[start_col])
+
+    return key
+
+
+def records(handle):
+    """Yield the non-empty lines of handle, each ending with a newline"""
+    for line in handle:
+        if line.strip():
+            yield line if line.endswith("\n") else line + "\n"
+
+
+def is_sorted(filename, spec):
+    """
+    Check if the records are grouped per chromosome
+    and sorted by start position within a chromosome, as required by tabix
+    """
+    key = sort_key(spec)
+    seen = set()
+    previous = (None, -1)
+    with open_text(filename) as f:
+        for line in itertools.islice(records(f), spec["line_skip"], None):
+            chromosome, start = key(line)
+            if chromosome != previous[0]:
+                if chromosome in seen:
+                    return False
+                seen.add(chromosome)
+            elif start < previous[1]:
+                return False
+            previous = (chromosome, start)
+    return True
+
+
+def sort_to_bgzf(filename, outfile, spec, chunk_lines=1000000):
+    """
+    Sort the records of filename on chromosome and start and write them bgzip compressed
+
+    Chunks of chunk_lines are sorted in memory and written to temporary files,
+    which are merged afterwards to keep memory usage bounded
+    """
+    import pysam
+
+    key = sort_key(spec)
+    Path(outfile).parent.mkdir(parents=True, exist_ok=True)
+    with tempfile.TemporaryDirectory(dir=Path(outfile).parent) as tmpdir:
+        with open_text(filename) as f:
+            lines = records(f)
+            header = list(itertools.islice(lines, spec["line_skip"]))
+            runs = []
+            while True:
+                chunk = sorted(itertools.islice(lines, chunk_lines), key=key)
+                if not chunk:
+                    break
+                run = Path(tmpdir) / f"run{len(runs)}.tsv"
+                with open(run, "w") as out:
+                    out.writelines(chunk)
+                runs.append(run)
+        logging.info(f"Merging {len(runs)} sorted chunks of {filename} into {outfile}.")
+        handles = [open(run) for run in runs]
+        try:
+            with pysam.BGZFile(outfile, "wb") as out:
+                out.write("".join(header).encode())
+                merged = heapq.merge(*handles, key=key)
+                while True:
+                    block = "".join(itertools.islice(merged, 100000))
+                    if not block:
+                        break
+                    out.write(block.encode())
+        finally:
+            for handle in handles:
+                handle.close()
@@ -1,33 +1,199 @@
 import methplotlib.plots as plots
 import methplotlib.utils as utils
 import methplotlib.qc as qc
-from methplotlib.import_methylation import get_data
+from methplotlib.import_methylation import get_data, set_batch_windows, shutdown_workers
+from multiprocessing.util import Finalize
 import logging
+import sys
 
 
 def main():
+    if len(sys.argv) > 1 and sys.argv[1] == "index":
+        from methplotlib.indexing import main as index_main
+
+        index_main(sys.argv[2:])
+        return
+    if len(sys.argv) > 1 and sys.argv[1] == "annotation-index":
+        from methplotlib.annotation import index_main
+
+        index_main(sys.argv[2:])
+        return
     args = utils.get_args()
     if args.example:
         utils.print_example()
     utils.init_logs(args)
-    windows = utils.make_windows(args.window, fasta=args.fasta)
-    for window in windows:
-        logging.info(f"Processing {window.string}")
-        meth_data = get_data(args, window)
-        if args.store:
-            import pickle
-
-            pickle.dump(
-                obj=meth_data,
-                file=open(f"methplotlib-data-{window.string}.pickle", "wb"),
-            )
-        logging.info(f"Collected methylation data for {len(meth_data)} datasets")
-        qc.qc_plots(meth_data, window, qcpath=args.qcfile, outpath=args.outfile)
-        logging.info("Created QC plots")
-        meth_browser(meth_data, window, args)
+    if args.windows:
+        windows = utils.read_windows(args.windows)
+        logging.info(f"Read {len(windows)} windows from {args.windows}")
+        set_batch_windows(windows)
+    else:
+        windows = utils.make_windows(args.window, fasta=args.fasta)
+    if args.auto_index:
+        from methplotlib.indexing import ensure_indexed
+
+        # once here, rather than concurrently in every worker process
+        args.methylation = [ensure_indexed(f) for f in args.methylation]
+    if args.lazy:
+        # a single copy of plotly.js, shared by the pages of all windows
+        args.plotlyjs = utils.write_plotlyjs(args.plotlyjs_dir or utils.output_directory(windows, args))
+    else:
+        args.plotlyjs = None
+    if args.processes > 1 and len(windows) > 1:
+        process_windows_parallel(windows, args)
+    else:
+        try:
+            for window, meth_data in prefetch_data(windows, args):
+                plot_window(window, meth_data, args)
+        except BaseException:
+            flush_after_error()
+            raise
+        utils.flush_static_images()
+    shutdown_workers()
     logging.info("Finished!")
 
 
+def process_window(window, args):
+    """Load the data, make the qc report and the browser for window"""
+    plot_window(window, load_window(window, args), args)
+
+
+def load_window(window, args):
+    logging.info(f"Processing {window.string}")
+    meth_data = get_data(args, window)
+    logging.info(f"Collected methylation data for {len(meth_data)} datasets")
+    return meth_data
+
+
+def plot_window(window, meth_data, args):
+    qc.qc_plots(
+        meth_data,
+        window,
+        qcpath=args.qcfile,
+        outpath=args.outfile,
+        lazy=args.lazy,
+        plotlyjs=args.plotlyjs,
+    )
+    logging.info("Created QC plots")
+    meth_browser(meth_data, window, args)
+
+
+def prefetch_data(windows, args):
+    """
+    Yield every window with its data
+
+    With args.prefetch > 0 the data is loaded in a background thread,
+    which runs at most args.prefetch windows ahead of the window being plotted
+    Errors while loading are raised when the window in question is reached
+    """
+    if args.prefetch < 1 or len(windows) == 1:
+        for window in windows:
+            yield window, load_window(window, args)
+        return
+    import queue
+    import threading
+
+    loaded = queue.Queue(maxsize=args.prefetch)
+    stop = threading.Event()
+
+    def load():
+        for window in windows:
+            try:
+                item = (window, load_window(window, args), None)
+            except BaseException as e:  # including the SystemExit of input errors
+                item = (window, None, e)
+            while not stop.is_set():
+                try:
+                    loaded.put(item, timeout=0.1)
+                    break
+                except queue.Full:
+                    pass
+            if stop.is_set() or item[2] is not None:
+                return
+
+    thread = threading.Thread(target=load, name="prefetch", daemon=True)
+    thread.start()
+    try:
+        for _ in windows:
+            window, meth_data, error = loaded.get()
+            if error is not None:
+                raise error
+            yield window, meth_data
+    finally:
+        stop.set()
+        thread.join()
+
+
+def init_window_worker(queue, windows):
+    utils.init_worker_logs(queue)
+    set_batch_windows(windows)
+    # The static images are queued over all windows of the worker and exported when it exits,
+    # after which the executors of read_mods_parallel (-t) have to be shut down,
+    # as their processes keep the worker from exiting.
+    # A worker process exits through os._exit, skipping atexit handlers, but runs the
+    # multiprocessing finalizers, those with a priority before joining its child processes.
+    # Priority 20 runs this before the finalizers of priority 10 which close the queues
+    # of the executors, after which these can't be told to stop anymore.
+    Finalize(None, finish_window_worker, exitpriority=20)
+
+
+def finish_window_worker():
+    try:
+        utils.flush_static_images()
+    except Exception:
+        # logged here, as the errors of finalizers are only printed
+        logging.exception("Error writing the static images of a worker process.")
+        raise
+    finally:
+        shutdown_workers()
+
+
+def flush_after_error():
+    """Write the static images queued before an error, logging rather than raising its errors"""
+    try:
+        utils.flush_static_images()
+    except Exception:
+        logging.exception("Error writing the static images queued before the error.")
+
+
+def process_windows_parallel(windows, args):
+    """
+    Run process_window for every window in a pool of args.processes processes
+
+    The log records of the workers are sent over a queue and written by this process
+    Errors are collected for all windows and reported together
+    """
+    from concurrent.futures import ProcessPoolExecutor
+    from logging.handlers import QueueListener
+    import multiprocessing
+
+    workers = min(args.processes, len(windows))
+    logging.info(f"Processing {len(windows)} windows using {workers} processes.")
+    queue = multiprocessing.Queue()
+    listener = QueueListener(queue, *logging.getLogger().handlers)
+    listener.start()
+    errors = []
+    try:
+        with ProcessPoolExecutor(
+            max_workers=workers,
+            initializer=init_window_worker,
+            initargs=(queue, windows if args.windows else []),
+        ) as executor:
+            futures = [executor.submit(process_window, window, args) for window in windows]
+            for window, future in zip(windows, futures):
+                try:
+                    future.result()
+                except SystemExit as e:
+                    errors.append(f"{window.string}: {e.code}")
+                except Exception as e:
+                    errors.append(f"{window.string}: {type(e).__name__}: {e}")
+    finally:
+        listener.stop()
+    if errors:
+        for error in errors:
+            logging.error(f"Error processing {error}")
+        sys.exit("\n\n\nERROR processing the following window(s):\n" + "\n".join(errors) + "\n")
+
+
 def meth_browser(meth_data, window, args):
     """
     meth_Data is a list of Methylation objects from the import_methylation submodule
@@ -40,7 +206,15 @@ def meth_browser(meth_data, window, args):
     the trace to be used for annotation is thus always num_methrows + 1
     """
     meth_traces = plots.methylation(
-        meth_data, dotsize=args.dotsize, binary=args.binary, minqual=args.minqual
+        meth_data,
+        dotsize=args.dotsize,
+        binary=args.binary,
+        minqual=args.minqual,
+        max_cov=args.max_cov,
+        renderer=args.renderer,
+        webgl_threshold=args.webgl_threshold,
+        max_points=args.max_points,
+        per_read_mode=args.per_read_mode,
     )
     logging.info("Prepared methylation traces.")
     if args.split or meth_traces.split:
@@ -133,11 +307,9 @@ def meth_browser(meth_data, window, args):
     if num_methrows > 10:
         for i in fig["layout"]["annotations"]:
             i["font"]["size"] = 10
-    utils.create_browser_output(fig, args.outfile, window)
+    utils.create_browser_output(fig, args.outfile, window, lazy=args.lazy, plotlyjs=args.plotlyjs)
     if args.static:
-        import plotly.io as pio
-
-        pio.write_image(fig, args.static, engine="kaleido")
+        utils.write_static_image(fig, args.static.format(region=window.string))
 
 
 if __name__ == "__main__":
@@ -1,12 +1,24 @@
 import plotly.graph_objs as go
 from methplotlib.annotation import parse_annotation, parse_bed
 import sys
-from sklearn.preprocessing import MinMaxScaler
 import pandas as pd
 import numpy as np
 
 
 legend_made = False
+# number of points above which traces are drawn with WebGL when renderer is "auto"
+WEBGL_THRESHOLD = 50000
+# maximal number of columns of per read heatmaps, wider windows are binned
+HEATMAP_BINS = 1000
+# the RdBu colorscale from plotly 3.0.0
+OLD_RDBU = [
+    [0, "rgb(5,10,172)"],
+    [0.35, "rgb(106,137,247)"],
+    [0.5, "rgb(190,190,190)"],
+    [0.6, "rgb(220,170,132)"],
+    [0.7, "rgb(230,145,90)"],
+    [1, "rgb(178,10,28)"],
+]
 
 
 class DataTraces(object):
@@ -100,10 +112,26 @@ def bed_annotation(bed, window):
     ]
 
 
-def methylation(meth_data, dotsize=4, binary=False, minqual=20):
+def methylation(
+    meth_data,
+    dotsize=4,
+    binary=False,
+    minqual=20,
+    max_cov=100,
+    renderer="auto",
+    webgl_threshold=WEBGL_THRESHOLD,
+    max_points=None,
+    per_read_mode="dots",
+):
     """
     Plot methylation traces from various data types
+
+    renderer is "svg", "webgl" or "auto",
+    the latter using WebGL for traces with more than webgl_threshold points
+    frequency and bedgraph lines with more than max_points points are downsampled
+    per_read_mode "heatmap" draws the calls of per read data as a heatmap instead of dots
     """
+    render = dict(renderer=renderer, threshold=webgl_threshold)
     traces = []
     types = []
     names = []
@@ -114,8 +142,11 @@ def methylation(meth_data, dotsize=4, binary=False, minqual=20):
                 make_per_read_meth_traces_llr(
                     table=meth.table,
                     phased=meth.data_type == "nanopolish_phased",
+                    max_cov=max_cov,
                     dotsize=dotsize,
                     binary=binary,
+                    render=render,
+                    mode=per_read_mode,
                 )
             )
             split = True
@@ -123,11 +154,12 @@ def methylation(meth_data, dotsize=4, binary=False, minqual=20):
             traces.append(plot_nanocompore(meth.table, dotsize=dotsize))
             split = True
         elif meth.data_type == "nanopolish_freq":
+            x, y = downsample(meth.table.index, meth.table["methylated_frequency"], max_points)
             traces.append(
                 [
-                    go.Scatter(
-                        x=meth.table.index,
-                        y=meth.table["methylated_frequency"],
+                    scatter_type(len(x), **render)(
+                        x=x,
+                        y=y,
                         mode="lines",
                         name=meth.name,
                         hoverinfo="name",
@@ -135,11 +167,12 @@ def methylation(meth_data, dotsize=4, binary=False, minqual=20):
                 ]
             )
         elif meth.data_type == "bedmethyl_extended":
+            x, y = downsample(meth.table["Start"], meth.table["modified_frequency"], max_points)
             traces.append(
                 [
-                    go.Scatter(
-                        x=meth.table["Start"],
-                        y=meth.table["modified_frequency"],
+                    scatter_type(len(x), **render)(
+                        x=x,
+                        y=y,
                         mode="lines+markers",
                         name=meth.name,
                         hoverinfo=["name", "x"],
@@ -152,20 +185,26 @@ def methylation(meth_data, dotsize=4, binary=False, minqual=20):
                 make_per_read_meth_traces_phred(
                     table=meth.table,
                     minmax_table=meth.start_end_table,
+                    max_cov=max_cov,
                     dotsize=dotsize,
                     minqual=minqual,
+                    render=render,
+                    mode=per_read_mode,
                 )
             )
             split = True
         elif meth.data_type == "bedgraph":
-            starts = meth.table["Start"]
-            ends = meth.table["End"]
-            vals = meth.table["Value"]
+            # a step for every record: (start, value), (end, value)
+            x, y = downsample(
+                np.column_stack([meth.table["Start"], meth.table["End"]]).ravel(),
+                np.repeat(meth.table["Value"].to_numpy(), 2),
+                max_points,
+            )
             traces.append(
                 [
-                    go.Scatter(
-                        x=[val for pair in zip(starts, ends) for val in pair],
-                        y=[val for pair in zip(vals, vals) for val in pair],
+                    scatter_type(len(x), **render)(
+                        x=x,
+                        y=y,
                         mode="lines",
                         name=meth.name,
                         hoverinfo="name",
@@ -179,41 +218,70 @@ def methylation(meth_data, dotsize=4, binary=False, minqual=20):
     return DataTraces(traces=traces, types=types, names=names, split=split)
 
 
+def downsample(x, y, max_points=None):
+    """
+    Reduce a line with more than max_points points (sorted by x) to at most max_points points
+
+    x is divided in max_points // 2 - 1 bins of equal width (like pixels),
+    keeping the points with the lowest and highest y per bin and the first and last point,
+    which preserves the shape of the line. Missing values of y are dropped.
+    Lines with at most max_points points are returned unchanged.
+    """
+    if not max_points or len(x) <= max_points:
+        return x, y
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    x, y = x[~np.isnan(y)], y[~np.isnan(y)]
+    if len(x) <= max_points:
+        return x, y
+    bins = max(max_points // 2 - 1, 1)
+    edges = np.linspace(x[0], x[-1], bins + 1)
+    bin_of = np.clip(np.searchsorted(edges, x, side="right") - 1, 0, bins - 1)
+    by_bin_and_y = np.lexsort((y, bin_of))
+    sorted_bins = bin_of[by_bin_and_y]
+    first = np.flatnonzero(np.r_[True, sorted_bins[1:] != sorted_bins[:-1]])
+    last = np.r_[first[1:], len(sorted_bins)] - 1
+    keep = np.unique(
+        np.concatenate([[0, len(x) - 1], by_bin_and_y[first], by_bin_and_y[last]])
+    )
+    return x[keep], y[keep]
+
+
+def scatter_type(num_points, renderer="auto", threshold=WEBGL_THRESHOLD):
+    """Return go.Scattergl if renderer is webgl or if renderer is auto and the trace
+    has more than threshold points, otherwise go.Scatter (svg)"""
+    if renderer == "webgl" or (renderer == "auto" and num_points > threshold):
+        return go.Scattergl
+    return go.Scatter
+
+
 def make_per_read_meth_traces_phred(
-    table, minmax_table, max_cov=100, dotsize=4, minqual=20
+    table, minmax_table, max_cov=100, dotsize=4, minqual=20, render=None, mode="dots"
 ):
     """Make traces for each read"""
     df_heights = assign_y_height_per_read(minmax_table, max_coverage=max_cov)
     table = table.join(df_heights, on="read_name", how="outer")
-    traces = []
-    hidden = 0
-    for read in table["read_name"].unique():
-        strand = table.loc[table["read_name"] == read, "strand"].values[0]
-        try:
-            traces.append(
-                make_per_read_line_trace(
-                    read_range=minmax_table.loc[read],
-                    y_pos=df_heights.loc[read, "height"],
-                    strand=strand,
-                )
-            )
-        except KeyError:
-            hidden += 1
-            continue
+    reads, hidden = per_read_table(table, ["strand"], minmax_table, df_heights)
     if hidden:
         sys.stderr.write(
             f"Warning: hiding {hidden} reads because coverage above {max_cov}x.\n"
         )
-    traces.append(
-        make_per_position_phred_scatter(
-            read_table=table[table["quality"] > minqual], dotsize=dotsize
-        )
+    traces = make_per_read_line_traces(
+        read_range=reads, y_pos=reads["height"], strand=reads["strand"]
     )
+    if mode == "heatmap":
+        traces.append(make_per_read_phred_heatmap(read_table=table[table["quality"] > minqual]))
+    else:
+        traces.append(
+            make_per_position_phred_scatter(
+                read_table=table[table["quality"] > minqual], dotsize=dotsize, **(render or {})
+            )
+        )
     return traces
 
 
 def make_per_read_meth_traces_llr(
-    table, phased=False, max_cov=100, dotsize=4, binary=False
+    table, phased=False, max_cov=100, dotsize=4, binary=False, render=None, mode="dots"
 ):
     """Make traces for each read"""
     minmax_table = find_min_and_max_pos_per_read(table, phased=phased)
@@ -229,49 +297,34 @@ def make_per_read_meth_traces_llr(
         table.loc[:, "llr_scaled"] = rescale_log_likelihood_ratio(
             table["log_lik_ratio"].copy()
         )
-    traces = []
-    hidden = 0
-    for read in table["read_name"].unique():
-        strand = table.loc[table["read_name"] == read, "strand"].values[0]
-        if phased:
-            phase = table.loc[table["read_name"] == read, "HP"].values[0]
-        else:
-            phase = None
-        try:
-            traces.append(
-                make_per_read_line_trace(
-                    read_range=minmax_table.loc[read],
-                    y_pos=df_heights.loc[read, "height"],
-                    strand=strand,
-                    phase=phase,
-                    size=dotsize,
-                )
-            )
-        except KeyError:
-            hidden += 1
-            continue
+    reads, hidden = per_read_table(
+        table, ["strand", "HP"] if phased else ["strand"], minmax_table, df_heights
+    )
     if hidden:
         sys.stderr.write(
             f"Warning: hiding {hidden} reads because coverage above {max_cov}x.\n"
         )
-    traces.append(
-        make_per_position_likelihood_scatter(read_table=table, dotsize=dotsize)
+    traces = make_per_read_line_traces(
+        read_range=reads,
+        y_pos=reads["height"],
+        strand=reads["strand"],
+        phase=reads["HP"] if phased else None,
+        size=dotsize,
     )
+    if mode == "heatmap":
+        traces.append(make_per_read_likelihood_heatmap(read_table=table))
+    else:
+        traces.append(
+            make_per_position_likelihood_scatter(
+                read_table=table, dotsize=dotsize, **(render or {})
+            )
+        )
     return traces
 
 
 def find_min_and_max_pos_per_read(table, phased=False):
     """Return a table with for every read the minimum and maximum position"""
-    mm_table = (
-        table.loc[:, ["read_name", "pos"]]
-        .groupby("read_name")
-        .min()
-        .join(
-            table.loc[:, ["read_name", "pos"]].groupby("read_name").max(),
-            lsuffix="min",
-            rsuffix="max",
-        )
-    )
+    mm_table = table.groupby("read_name", observed=True)["pos"].agg(posmin="min", posmax="max")
     if phased:
         return mm_table.join(
             table.loc[:, ["read_name", "HP"]]
@@ -282,36 +335,71 @@ def find_min_and_max_pos_per_read(table, phased=False):
         return mm_table
 
 
+def per_read_table(table, columns, minmax_table, df_heights):
+    """Return a table with for every read the columns of its first record,
+    its minimum and maximum position and its height, in order of appearance in table,
+    and the number of reads without height (or without positions)"""
+    first = table.drop_duplicates(subset="read_name")
+    reads = (
+        first.set_index(first["read_name"].astype(object))
+        .loc[:, columns]
+        .join(minmax_table.loc[:, ["posmin", "posmax"]], how="inner")
+        .join(df_heights, how="inner")
+    )
+    return reads, len(first) - len(reads)
+
+
 def assign_y_height_per_read(df, phased=False, max_coverage=1000):
     """Assign height of the read in the per read traces
 
     Gets a dataframe of read_name, posmin and posmax.
     Sorting by position, and optionally by phase block.
-    Determines optimal height (y coordinate) for this read
+    Every read gets the lowest height (y coordinate) at which it doesn't overlap
+    with the previous reads, reads for which no height <= max_coverage is available are dropped
 
-    Returns a dictionary mapping read_name to y_coord
+    The heights which are free are kept in a heap, as are the occupied heights by their end,
+    making this O(n log n) rather than O(n * max_coverage)
+
+    Returns a dataframe mapping read_name to height
     """
+    import heapq
+
     if phased:
         dfs = df.sort_values(
             by=["HP", "posmin", "posmax"], ascending=[True, True, False]
         )
     else:
         dfs = df.sort_values(by=["posmin", "posmax"], ascending=[True, False])
-    heights = [[] for i in range(max_coverage)]
-    y_pos = dict()
-    for read in dfs.itertuples():
-        for y, layer in enumerate(heights, start=1):
-            if len(layer) == 0:
-                layer.append(read.posmax)
-                y_pos[read.Index] = y
-                break
-            if read.posmin > layer[-1]:
-                layer.append(read.posmax)
-                y_pos[read.Index] = y
-                break
+    posmins = dfs["posmin"].to_numpy()
+    posmaxs = dfs["posmax"].to_numpy()
+    heights = np.zeros(len(dfs), dtype=np.int64)
+    last_end = {}  # height -> end of the last read at that height
+    occupied = []  # heap of (end of the last read, height)
+    free = []  # heap of heights
+    previous = None
+    for i, (posmin, posmax) in enumerate(zip(posmins.tolist(), posmaxs.tolist())):
+        if previous is not None and posmin < previous:
+            # a new phase block starts again on the left, all heights have to be checked again
+            occupied = [(last_end[y], y) for y in last_end]
+            heapq.heapify(occupied)
+            free = []
+        previous = posmin
+        while occupied and occupied[0][0] < posmin:
+            heapq.heappush(free, heapq.heappop(occupied)[1])
+        if free:
+            y = heapq.heappop(free)
+        elif len(last_end) < max_coverage:
+            y = len(last_end) + 1
+        else:
+            continue
+        heights[i] = y
+        last_end[y] = posmax
+        heapq.heappush(occupied, (posmax, y))
+    placed = heights > 0
     return pd.DataFrame(
-        {"read": list(y_pos.keys()), "height": list(y_pos.values())}
-    ).set_index("read")
+        {"height": heights[placed]},
+        index=pd.Index(np.asarray(dfs.index, dtype=object)[placed], name="read"),
+    )
 
 
 def rescale_log_likelihood_ratio(llr):
@@ -320,12 +408,16 @@ def rescale_log_likelihood_ratio(llr):
 
     positive ratios between 0 and 1
     negative ratios between -1 and 0
+    using min-max scaling of the positive and negative ratios separately
     """
-    scaler = MinMaxScaler(feature_range=(0, 1))
-    llr[llr > 0] = scaler.fit_transform(llr[llr > 0].values.reshape(-1, 1)).tolist()
-    scaler = MinMaxScaler(feature_range=(-1, 0))
-    llr[llr < 0] = scaler.fit_transform(llr[llr < 0].values.reshape(-1, 1)).tolist()
-    return llr
+    values = llr.to_numpy()
+    scaled = values.copy()
+    for selection, lowest in [(values > 0, 0), (values < 0, -1)]:
+        if selection.any():
+            selected = values[selection]
+            span = selected.max() - selected.min()
+            scaled[selection] = (selected - selected.min()) / (span if span else 1) + lowest
+    return pd.Series(scaled, index=llr.index, name=llr.name)
 
 
 def binarize_log_likelihood_ratio(llr, cutoff=2):
@@ -341,47 +433,59 @@ def binarize_log_likelihood_ratio(llr, cutoff=2):
     return llr
 
 
-def make_per_read_line_trace(read_range, y_pos, strand, phase=None, size=4):
-    """Make a grey line trace for a single read,
-    with black arrow symbols on the edges indicating strand"""
-    symbol = "triangle-right" if strand == "+" else "triangle-left"
-    if phase:
-        if phase == 1:
-            color = "lightgreen"
-        elif phase == 2:
-            color = "yellow"
-        else:  # phase is np.nan
-            color = "black"
+def make_per_read_line_traces(read_range, y_pos, strand, phase=None, size=4):
+    """Make a grey line trace for all reads, with gaps between the reads,
+    and a trace with black arrow symbols on the edges of the reads indicating strand
+
+    read_range is a table with posmin and posmax per read,
+    y_pos, strand and phase are sequences with a value per read
+    The symbols are colored by phase (1: lightgreen, 2: yellow, otherwise black)"""
+    posmin = np.asarray(read_range["posmin"], dtype=float)
+    posmax = np.asarray(read_range["posmax"], dtype=float)
+    y_pos = np.asarray(y_pos, dtype=float)
+    symbol = np.where(np.asarray(strand) == 1, "triangle-right", "triangle-left")
+    if phase is None:
+        color = np.full(len(y_pos), "black")
     else:
-        color = "black"
-    return go.Scatter(
-        x=[read_range["posmin"], read_range["posmax"]],
-        y=[y_pos, y_pos],
-        mode="lines+markers",
-        line=dict(width=1, color="lightgrey"),
-        showlegend=False,
-        marker=dict(
-            symbol=symbol,
-            size=size * 2,
-            color=color,
-            line=dict(width=0.5, color="black"),
+        phase = np.asarray(phase, dtype=float)
+        color = np.select([phase == 1, phase == 2], ["lightgreen", "yellow"], "black")
+    # NaN separates the reads in a single line trace
+    line_x = np.full(len(y_pos) * 3, np.nan)
+    line_x[0::3] = posmin
+    line_x[1::3] = posmax
+    line_y = np.full(len(y_pos) * 3, np.nan)
+    line_y[0::3] = y_pos
+    line_y[1::3] = y_pos
+    return [
+        go.Scatter(
+            x=line_x,
+            y=line_y,
+            mode="lines",
+            line=dict(width=1, color="lightgrey"),
+            showlegend=False,
         ),
-    )
+        go.Scatter(
+            x=np.column_stack([posmin, posmax]).ravel(),
+            y=np.repeat(y_pos, 2),
+            mode="markers",
+            showlegend=False,
+            marker=dict(
+                symbol=np.repeat(symbol, 2),
+                size=size * 2,
+                color=np.repeat(color, 2),
+                line=dict(width=0.5, color="black"),
+            ),
+        ),
+    ]
 
 
-def make_per_position_likelihood_scatter(read_table, maxval=0.75, dotsize=4):
+def make_per_position_likelihood_scatter(
+    read_table, maxval=0.75, dotsize=4, renderer="auto", threshold=WEBGL_THRESHOLD
+):
     """Make scatter plot per CpG per read
     with the RdBu colorscale from plotly 3.0.0, showing the
     scaled log likelihood of having methylation here"""
-    old_RdBu = [
-        [0, "rgb(5,10,172)"],
-        [0.35, "rgb(106,137,247)"],
-        [0.5, "rgb(190,190,190)"],
-        [0.6, "rgb(220,170,132)"],
-        [0.7, "rgb(230,145,90)"],
-        [1, "rgb(178,10,28)"],
-    ]
-    return go.Scatter(
+    return scatter_type(len(read_table), renderer, threshold)(
         x=read_table["pos"],
         y=read_table["height"],
         mode="markers",
@@ -393,7 +497,7 @@ def make_per_position_likelihood_scatter(read_table, maxval=0.75, dotsize=4):
             color=read_table["llr_scaled"],
             cmin=-maxval,
             cmax=maxval,
-            colorscale=old_RdBu,
+            colorscale=OLD_RDBU,
             showscale=True,
             colorbar=dict(
                 title="Modification likelihood",
@@ -406,11 +510,14 @@ def make_per_position_likelihood_scatter(read_table, maxval=0.75, dotsize=4):
     )
 
 
-def make_per_position_phred_scatter(read_table, dotsize=4):
+def make_per_position_phred_scatter(
+    read_table, dotsize=4, renderer="auto", threshold=WEBGL_THRESHOLD
+):
     """Make scatter plot per CpG per read"""
     global legend_made
+    scatter = scatter_type(len(read_table), renderer, threshold)
     if legend_made or read_table.dropna().empty:
-        return go.Scatter(
+        return scatter(
             x=read_table["pos"],
             y=read_table["height"],
             mode="markers",
@@ -421,7 +528,7 @@ def make_per_position_phred_scatter(read_table, dotsize=4):
         )
     else:
         legend_made = True
-        return go.Scatter(
+        return scatter(
             x=read_table["pos"],
             y=read_table["height"],
             mode="markers",
@@ -443,6 +550,82 @@ def make_per_position_phred_scatter(read_table, dotsize=4):
         )
 
 
+def per_read_heatmap_matrix(read_table, column, max_bins=HEATMAP_BINS):
+    """Return the x and y coordinates and z matrix (heights * positions) of a per read heatmap
+
+    The cells contain the mean of column for the calls of a read in a position (bin),
+    rounded to 3 decimals (beyond the resolution of a colorscale),
+    windows wider than max_bins positions are binned and missing calls are NaN
+    Calls of reads without height (hidden because of the coverage) are dropped
+    """
+    read_table = read_table.dropna(subset=["height", column])
+    if read_table.empty:
+        return [], [], [[]]
+    pos = read_table["pos"].to_numpy().astype(np.int64)
+    rows = read_table["height"].to_numpy().astype(np.int64) - 1
+    first = pos.min()
+    width = max(int(np.ceil((pos.max() - first + 1) / max_bins)), 1)
+    columns = (pos - first) // width
+    shape = (rows.max() + 1, columns.max() + 1)
+    cells = rows * shape[1] + columns
+    values = read_table[column].to_numpy(dtype=float)
+    sums = np.bincount(cells, weights=values, minlength=shape[0] * shape[1])
+    counts = np.bincount(cells, minlength=shape[0] * shape[1])
+    with np.errstate(invalid="ignore", divide="ignore"):
+        z = np.round(sums / counts, 3).reshape(shape)
+    x = first + np.arange(shape[1]) * width + (width - 1) / 2
+    return x, np.arange(1, shape[0] + 1), z
+
+
+def make_per_read_likelihood_heatmap(read_table, maxval=0.75):
+    """Make a heatmap per read and position
+    with the colors of make_per_position_likelihood_scatter"""
+    x, y, z = per_read_heatmap_matrix(read_table, "llr_scaled")
+    return go.Heatmap(
+        x=x,
+        y=y,
+        z=z,
+        zmin=-maxval,
+        zmax=maxval,
+        colorscale=OLD_RDBU,
+        hoverongaps=False,
+        colorbar=dict(
+            title="Modification likelihood",
+            titleside="right",
+            tickvals=[-maxval, 0, maxval],
+            ticktext=["Likely <br> unmodified", "0", "Likely <br> modified"],
+            ticks="outside",
+        ),
+    )
+
+
+def make_per_read_phred_heatmap(read_table):
+    """Make a heatmap per read and position
+    with the colors of make_per_position_phred_scatter"""
+    global legend_made
+    x, y, z = per_read_heatmap_matrix(read_table, "quality")
+    if legend_made or read_table.dropna().empty:
+        return go.Heatmap(x=x, y=y, z=z, colorscale="Reds", hoverongaps=False, showscale=False)
+    else:
+        legend_made = True
+        return go.Heatmap(
+            x=x,
+            y=y,
+            z=z,
+            zmin=read_table["quality"].min(),
+            zmax=read_table["quality"].max(),
+            colorscale="Reds",
+            hoverongaps=False,
+            colorbar=dict(
+                title="Modification probability",
+                titleside="right",
+                tickvals=[read_table["quality"].min(), read_table["quality"].max()],
+                ticktext=["Likely <br> unmodified", "Likely <br> modified"],
+                ticks="outside",
+            ),
+        )
+
+
 def plot_nanocompore(table, dotsize=4):
     return [
         go.Scatter(
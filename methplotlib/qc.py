@@ -1,11 +1,10 @@
-from sklearn.decomposition import PCA
 import plotly.express as px
 import pandas as pd
 import plotly
 import plotly.graph_objs as go
 
 
-def qc_plots(meth_data, window, qcpath=None, outpath=None):
+def qc_plots(meth_data, window, qcpath=None, outpath=None, lazy=False, plotlyjs=None):
 
     if qcpath is None and outpath is None:
         outfile = f"qc_report_{window.string}.html"
@@ -16,34 +15,41 @@ def qc_plots(meth_data, window, qcpath=None, outpath=None):
         outfile = str(p.parent / PosixPath("qc_" + p.stem + ".html"))
     else:
         from pathlib import Path
-        p = Path(qcpath)
+        outfile = qcpath.format(region=window.string)
+        p = Path(outfile)
         Path.mkdir(p.parent, exist_ok=True, parents=True)
-        outfile = qcpath
-
-    with open(outfile, 'w') as qc_report:
-        qc_report.write(num_sites_bar(meth_data))
-        if len([m for m in meth_data if m.data_type == "nanopolish_freq"]) > 0:
-            data = [m.table.rename({"methylated_frequency": m.name}, axis='columns')
-                    for m in meth_data if m.data_type == "nanopolish_freq"]
-            full = data[0].join(data[1:]).dropna(how="any", axis="index")
-            qc_report.write(modified_fraction_histogram(full))
-        if len([m for m in meth_data if m.data_type == "nanopolish_freq"]) > 2:
-            qc_report.write(pairwise_correlation_plot(full))
-            qc_report.write(pca(full))
-            qc_report.write(global_box(data))
-        if len([m for m in meth_data
-                if m.data_type in ["nanopolish_call", "nanopolish_phased"]]) > 2:
-            pass
+
+    figures = [num_sites_bar(meth_data)]
+    if len([m for m in meth_data if m.data_type == "nanopolish_freq"]) > 0:
+        data = [m.table.rename({"methylated_frequency": m.name}, axis='columns')
+                for m in meth_data if m.data_type == "nanopolish_freq"]
+        full = data[0].join(data[1:]).dropna(how="any", axis="index")
+        figures.append(modified_fraction_histogram(full))
+    if len([m for m in meth_data if m.data_type == "nanopolish_freq"]) > 2:
+        figures.append(pairwise_correlation_plot(full))
+        figures.append(pca(full))
+        figures.append(global_box(data))
+    if len([m for m in meth_data
+            if m.data_type in ["nanopolish_call", "nanopolish_phased"]]) > 2:
+        pass
+
+    if lazy:
+        from methplotlib.utils import write_lazy_html
+        write_lazy_html(figures, outfile, title=f"QC report {window.string}", plotlyjs=plotlyjs)
+    else:
+        with open(outfile, 'w') as qc_report:
+            for fig in figures:
+                qc_report.write(plotly.offline.plot(fig,
+                                                    output_type="div",
+                                                    show_link=False,
+                                                    include_plotlyjs='cdn'))
 
 
 def num_sites_bar(meth_data):
     trace = go.Bar(x=[m.name for m in meth_data],
                    y=[m.called_sites for m in meth_data])
     layout = dict(title="Number of called positions")
-    return plotly.offline.plot(dict(data=[trace], layout=layout),
-                               output_type="div",
-                               show_link=False,
-                               include_plotlyjs='cdn')
+    return dict(data=[trace], layout=layout)
 
 
 def pairwise_correlation_plot(full):
@@ -67,13 +73,12 @@ def pairwise_correlation_plot(full):
         layout[f"xaxis{i}"] = dict(showline=True, zeroline=False, gridcolor='#fff', ticklen=4)
         layout[f"yaxis{i}"] = dict(showline=True, zeroline=False, gridcolor='#fff', ticklen=4)
 
-    return plotly.offline.plot(dict(data=[trace], layout=layout),
-                               output_type="div",
-                               show_link=False,
-                               include_plotlyjs='cdn')
+    return dict(data=[trace], layout=layout)
 
 
 def pca(full):
+    from sklearn.decomposition import PCA
+
     sklearn_pca = PCA(n_components=2)
     pca = sklearn_pca.fit_transform(full.transpose())
     data = [dict(type='scatter',
@@ -94,10 +99,7 @@ def pca(full):
                   yaxis=dict(title='PC2', showline=False),
                   title="Principal Component Analysis"
                   )
-    return plotly.offline.plot(dict(data=data, layout=layout),
-                               output_type="div",
-                               show_link=False,
-                               include_plotlyjs='cdn')
+    return dict(data=data, layout=layout)
 
 
 def global_box(data):
@@ -105,10 +107,7 @@ def global_box(data):
                             .rename({d.columns[0]: "freq"}, axis="columns")
                             .assign(dataset=d.columns[0]) for d in data], ignore_index=True),
                  x="dataset", y="freq", title="Global frequency of modification")
-    return plotly.offline.plot(fig,
-                               output_type="div",
-                               show_link=False,
-                               include_plotlyjs='cdn')
+    return fig
 
 
 def modified_fraction_histogram(full):
@@ -123,8 +122,4 @@ def modified_fraction_histogram(full):
                   title="Histogram of modified fractions",
                   xaxis=dict(title="Modified fraction"),
                   yaxis=dict(title="Frequency"))
-    return plotly.offline.plot(dict(data=traces,
-                                    layout=layout),
-                               output_type="div",
-                               show_link=False,
-                               include_plotlyjs='cdn')
+    return dict(data=traces, layout=layout)
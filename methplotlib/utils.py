@@ -1,4 +1,4 @@
-from argparse import ArgumentParser, SUPPRESS
+from argparse import ArgumentParser
 import sys
 from math import ceil
 from methplotlib.version import __version__
@@ -66,6 +66,28 @@ def make_windows(full_window, max_size=1e6, fasta=None):
         return [reg]
 
 
+def read_windows(bedfile, max_size=1e6):
+    """
+    Read the regions of a bed file as Region objects, sorted by chromosome and begin
+
+    Duplicate regions are only returned once
+    and regions larger than max_size are split in chunks as in make_windows
+    """
+    import gzip
+
+    regions = set()
+    with gzip.open(bedfile, "rt") if is_gz_file(bedfile) else open(bedfile) as bed:
+        for line in bed:
+            if not line.strip() or line.startswith(("#", "track", "browser")):
+                continue
+            chromosome, begin, end = line.split("\t")[:3]
+            regions.add(f"{chromosome}:{int(begin)}-{int(end)}")
+    if not regions:
+        sys.exit(f"INPUT ERROR: No regions found in {bedfile}!")
+    windows = flatten([make_windows(region, max_size=max_size) for region in regions])
+    return sorted(windows, key=lambda w: (str(w.chromosome), w.begin, w.end))
+
+
 def flatten(nested_list):
     return list(chain.from_iterable(nested_list))
 
@@ -97,7 +119,12 @@ def get_args():
         "-w",
         "--window",
         help="window (region) to which the visualisation has to be restricted",
-        required=True if "--example" not in sys.argv else False,
+        required=True if "--example" not in sys.argv and "--windows" not in sys.argv else False,
+    )
+    parser.add_argument(
+        "--windows",
+        help="bed file with regions for which a browser has to be made, "
+        "reading every input only once for all regions",
     )
     parser.add_argument("-g", "--gtf", help="add annotation based on a gtf file")
     parser.add_argument("-b", "--bed", help="add annotation based on a bed file")
@@ -116,7 +143,25 @@ def get_args():
         help="split, rather than overlay the methylation tracks",
         action="store_true",
     )
-    parser.add_argument("--static", help="Make a static image of the browser window")
+    parser.add_argument(
+        "--static",
+        help="Make a static image of the browser window. "
+        "Use {region} as a shorthand for {chr}_{start}_{end} in the filename. "
+        "The images are exported in batches, per worker process with --processes.",
+    )
+    parser.add_argument(
+        "--lazy",
+        help="Write html pages which load the tracks from files next to them when in view, "
+        "with a local copy of plotly.js shared by the pages in a directory",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--plotlyjs",
+        help="Directory to write the plotly.js file shared by the --lazy pages to. "
+        "Default: the common directory of all output files",
+        metavar="DIR",
+        dest="plotlyjs_dir",
+    )
     parser.add_argument(
         "--binary",
         help="Make the nanopolish plot ignorning log likelihood nuances",
@@ -146,6 +191,61 @@ def get_args():
         type=int,
         default=20,
     )
+    parser.add_argument(
+        "--max-cov",
+        help="The maximal number of rows of reads in the per read plots, "
+        "reads which don't fit are hidden",
+        type=int,
+        default=100,
+    )
+    parser.add_argument(
+        "--per-read-mode",
+        help="Draw the calls in per read plots as dots or as a heatmap (faster for deep coverage)",
+        choices=["dots", "heatmap"],
+        default="dots",
+    )
+    parser.add_argument(
+        "--max-points",
+        help="Downsample frequency and bedgraph lines with more points "
+        "(keeping the minimum and maximum per bin), 0 to disable",
+        type=int,
+        default=5000,
+    )
+    parser.add_argument(
+        "--renderer",
+        help="Draw traces as svg, with WebGL or automatically with WebGL "
+        "when a trace has more than --webgl-threshold points",
+        choices=["auto", "svg", "webgl"],
+        default="auto",
+    )
+    parser.add_argument(
+        "--webgl-threshold",
+        help="The number of points of a trace above which WebGL is used with --renderer auto",
+        type=int,
+        default=50000,
+    )
+    parser.add_argument(
+        "-t",
+        "--threads",
+        help="Number of processes to use for reading the --methylation files in parallel, "
+        "also used as decompression threads for bam/cram input",
+        type=int,
+        default=1,
+    )
+    parser.add_argument(
+        "--processes",
+        help="Number of windows (chunks of a large --window or regions of --windows) "
+        "to load and plot concurrently in a process pool",
+        type=int,
+        default=1,
+    )
+    parser.add_argument(
+        "--prefetch",
+        help="Number of windows of which the data is loaded in the background "
+        "while plotting the current window, 0 to disable",
+        type=int,
+        default=1,
+    )
     parser.add_argument("--example", action="store_true", help="Show example command and exit.")
     parser.add_argument(
         "-o",
@@ -164,10 +264,39 @@ def get_args():
         "Use {region} as a shorthand for {chr}_{start}_{end} in the filename. "
         "Missing paths will be created.",
     )
-    parser.add_argument("--store", help=SUPPRESS, action="store_true")
+    parser.add_argument(
+        "--shard-size",
+        help="Split bam/cram windows larger than this (in bp) in shards, "
+        "extracted in parallel using --threads processes",
+        type=int,
+    )
+    parser.add_argument(
+        "--auto-index",
+        help="Sort, bgzip and index inputs without index (once) for fast access to windows",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--cache",
+        help="Directory in which parsed data is cached per input file and window, "
+        "to speed up plotting the same window again",
+    )
+    parser.add_argument(
+        "--cache-size",
+        help="Maximal size of the --cache directory in MB, "
+        "least recently used entries are removed first",
+        type=int,
+        default=1024,
+    )
     args = parser.parse_args()
     if not args.example and not len(args.names) == len(args.methylation):
         sys.exit("INPUT ERROR: Expecting the same number of names as datasets!")
+    if args.window and args.windows:
+        sys.exit("INPUT ERROR: Use either --window or --windows, not both!")
+    if args.windows:
+        outputs = {"--outfile": args.outfile, "--qcfile": args.qcfile, "--static": args.static}
+        for option, value in outputs.items():
+            if value and "{region}" not in value:
+                sys.exit(f"INPUT ERROR: {option} requires {{region}} in the filename with --windows!")
     return args
 
 
@@ -183,6 +312,17 @@ def init_logs(args):
     logging.info(f"Arguments are: {args}")
 
 
+def init_worker_logs(queue):
+    """Send the log records of a worker process to queue, to be written by the main process"""
+    from logging.handlers import QueueHandler
+
+    root = logging.getLogger()
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+    root.addHandler(QueueHandler(queue))
+    root.setLevel(logging.INFO)
+
+
 def print_example():
     import pkg_resources
 
@@ -291,7 +431,7 @@ def create_subplots(num_methrows, split, names=None, annotation=True):
         )
 
 
-def create_browser_output(fig, outfile, window):
+def create_browser_output(fig, outfile, window, lazy=False, plotlyjs=None):
     if outfile is None:
         outfile = f"methylation_browser_{window.string}.html"
     else:
@@ -301,21 +441,330 @@ def create_browser_output(fig, outfile, window):
         p = Path(outfile)
         Path.mkdir(p.parent, exist_ok=True, parents=True)
 
-    if outfile.endswith(".html"):
+    if outfile.endswith(".html") and lazy:
+        write_lazy_html(
+            [fig], outfile, title=f"Nucleotide modifications {window.string}", plotlyjs=plotlyjs
+        )
+    elif outfile.endswith(".html"):
         write_html_output(fig, outfile)
     else:
-        try:
-            fig.write_image(outfile)
-        except ValueError as e:
-            sys.stderr.write("\n\nERROR: creating the image in this file format failed.\n")
-            sys.stderr.write("ERROR: creating in default html format instead.\n")
-            sys.stderr.write("ERROR: additional packages required. Detailed error:\n")
-            sys.stderr.write(str(e))
-            write_html_output(fig, outfile)
+        write_static_image(fig, outfile, html_fallback=True)
+
+
+# figures waiting to be exported as static images, as (figure dict, file, html_fallback)
+_static_images = []
+STATIC_BATCH_SIZE = 16
+
+
+def write_static_image(fig, outfile, html_fallback=False):
+    """
+    Queue fig to be written as static image to outfile
+
+    The images are exported in batches of STATIC_BATCH_SIZE by flush_static_images,
+    which has to be called once all figures are added.
+    With html_fallback, an html file is written instead if the export fails
+    """
+    _static_images.append((fig.to_dict(), outfile, html_fallback))
+    if len(_static_images) >= STATIC_BATCH_SIZE:
+        flush_static_images()
+
+
+def flush_static_images():
+    """
+    Export the queued figures in a single kaleido session
+
+    The figures are validated already, and exported one by one
+    if the batch fails, to fall back to html only for the failing figures
+    """
+    if not _static_images:
+        return
+    batch = list(_static_images)
+    _static_images.clear()
+    logging.info(f"Writing {len(batch)} static image(s).")
+    try:
+        export_images([fig for fig, _, _ in batch], [outfile for _, outfile, _ in batch])
+    except ValueError:
+        for fig, outfile, html_fallback in batch:
+            try:
+                export_images([fig], [outfile])
+            except ValueError as e:
+                if not html_fallback:
+                    raise
+                sys.stderr.write("\n\nERROR: creating the image in this file format failed.\n")
+                sys.stderr.write("ERROR: creating in default html format instead.\n")
+                sys.stderr.write("ERROR: additional packages required. Detailed error:\n")
+                sys.stderr.write(str(e))
+                write_html_output(fig, outfile)
+
+
+def export_images(figures, outfiles):
+    import plotly.io as pio
+
+    if hasattr(pio, "write_images"):  # plotly >= 6.1, reusing one kaleido browser
+        pio.write_images(figures, outfiles, validate=False)
+    else:  # kaleido < 1 keeps a single export process alive between calls
+        for fig, outfile in zip(figures, outfiles):
+            pio.write_image(fig, outfile, engine="kaleido", validate=False)
 
 
 def write_html_output(fig, outfile):
     with open(outfile, "w+") as output:
         output.write(
-            plotly.offline.plot(fig, output_type="div", show_link=False, include_plotlyjs="cdn")
+            plotly.offline.plot(
+                compact_figure(fig),
+                output_type="div",
+                show_link=False,
+                include_plotlyjs="cdn",
+                validate=False,
+            )
+        )
+
+
+LAZY_HTML = """<!DOCTYPE html>
+<html>
+<head>
+<meta charset="utf-8">
+<title>{title}</title>
+<script src="{plotlyjs}"></script>
+</head>
+<body>
+{panels}
+<script>
+var figures = {figures};
+var methplotlib = (function () {{
+  var callbacks = {{}};
+  function load(src, callback) {{
+    callbacks[src] = callback;
+    var script = document.createElement("script");
+    script.src = src;
+    document.head.appendChild(script);
+  }}
+  function loaded(src, traces) {{
+    var callback = callbacks[src];
+    delete callbacks[src];
+    callback(traces);
+  }}
+  function draw(panel) {{
+    var figure = figures[panel.getAttribute("data-figure")];
+    Plotly.newPlot(panel, [], figure.layout, {{responsive: true}}).then(function () {{
+      (function next(i) {{
+        if (i < figure.tracks.length) {{
+          load(figure.tracks[i], function (traces) {{
+            Plotly.addTraces(panel, traces).then(function () {{ next(i + 1); }});
+          }});
+        }}
+      }})(0);
+    }});
+  }}
+  var panels = document.querySelectorAll(".methplotlib-panel");
+  if ("IntersectionObserver" in window) {{
+    var observer = new IntersectionObserver(function (entries) {{
+      entries.forEach(function (entry) {{
+        if (entry.isIntersecting) {{
+          observer.unobserve(entry.target);
+          draw(entry.target);
+        }}
+      }});
+    }}, {{rootMargin: "200px"}});
+    panels.forEach(function (panel) {{ observer.observe(panel); }});
+  }} else {{
+    panels.forEach(draw);
+  }}
+  return {{loaded: loaded}};
+}})();
+</script>
+</body>
+</html>
+"""
+
+
+def output_directory(windows, args):
+    """Return the common directory of the browser and qc pages of all windows"""
+    import os
+
+    directories = set()
+    for window in windows:
+        # without --qcfile the qc page is written next to the browser page
+        browser = os.path.dirname(args.outfile.format(region=window.string)) if args.outfile else ""
+        qc = os.path.dirname(args.qcfile.format(region=window.string)) if args.qcfile else browser
+        directories.update([os.path.abspath(browser), os.path.abspath(qc)])
+    return os.path.commonpath(directories)
+
+
+def write_plotlyjs(directory):
+    """
+    Write plotly.js to directory, unless present already, and return its path
+
+    The file is written under a temporary name first,
+    so that concurrent processes never load a partially written file
+    """
+    import os
+    import tempfile
+
+    directory = Path(directory)
+    directory.mkdir(exist_ok=True, parents=True)
+    plotlyjs = directory / f"plotly-{plotly.offline.get_plotlyjs_version()}.min.js"
+    if not plotlyjs.is_file():
+        fd, tmp = tempfile.mkstemp(dir=directory, suffix=".js")
+        with os.fdopen(fd, "w", encoding="utf-8") as out:
+            out.write(plotly.offline.get_plotlyjs())
+        os.chmod(tmp, 0o644)
+        os.replace(tmp, plotlyjs)
+    return str(plotlyjs)
+
+
+def write_lazy_html(figures, outfile, title="methplotlib", plotlyjs=None):
+    """
+    Write the figures as a small html page which loads the traces from sidecar files
+
+    The traces of every track (subplot row) are written compactly to
+    a script in the directory {outfile without .html}_files, replacing those of earlier runs.
+    plotlyjs is the path of a plotly.js file shared between pages (see write_plotlyjs),
+    by default written next to outfile, and is loaded by its relative path.
+    The script files are used rather than json to allow opening the page
+    from the filesystem without a web server.
+    A figure is drawn when its panel comes into view, after which the tracks are added in order
+    """
+    import html
+    import json
+    import os
+    from plotly.io.json import to_json_plotly
+
+    outfile = Path(outfile)
+    if plotlyjs is None:
+        plotlyjs = write_plotlyjs(outfile.parent)
+    plotlyjs_src = Path(os.path.relpath(plotlyjs, outfile.parent)).as_posix()
+    sidecar_dir = outfile.parent / (outfile.stem + "_files")
+    sidecar_dir.mkdir(exist_ok=True)
+    for stale in sidecar_dir.glob("figure*_*.js"):  # of an earlier run with other figures
+        stale.unlink()
+    panels = []
+    specs = []
+    for i, fig in enumerate(figures):
+        if isinstance(fig, dict):
+            fig = plotly.graph_objs.Figure(fig)
+        fig_dict = compact_figure(fig)
+        tracks = {}
+        for trace in fig_dict["data"]:
+            tracks.setdefault(trace.get("yaxis", "y"), []).append(trace)
+        sources = []
+        for axis, traces in tracks.items():
+            src = f"{sidecar_dir.name}/figure{i}_{axis}.js"
+            (outfile.parent / src).write_text(
+                f"methplotlib.loaded({json.dumps(src)}, {to_json_plotly(traces)});\n",
+                encoding="utf-8",
+            )
+            sources.append(src)
+        specs.append(dict(layout=fig_dict["layout"], tracks=sources))
+        height = fig_dict["layout"].get("height", 450)
+        panels.append(
+            f'<div class="methplotlib-panel" style="height:{height}px; width:100%;" '
+            f'data-figure="{i}"></div>'
         )
+    outfile.write_text(
+        LAZY_HTML.format(
+            title=html.escape(title),
+            plotlyjs=html.escape(plotlyjs_src),
+            panels="\n".join(panels),
+            figures=to_json_plotly(specs),
+        ),
+        encoding="utf-8",
+    )
+
+
+# arrays shorter than this are left as JSON lists
+TYPED_ARRAY_MIN_LENGTH = 16
+
+
+def compact_figure(fig):
+    """
+    Return the figure as a dict in which the numeric arrays of the traces are
+    base64 encoded typed arrays, as supported by plotly.js >= 2.28
+
+    The smallest dtype that represents the values is used,
+    positions (x) are kept exact while other values are stored as float32,
+    arrays are only replaced if the serialized typed array is shorter
+    (which it isn't for mostly NaN heatmaps, as / is escaped in the json)
+    and hover texts are rounded to 3 significant digits (if numeric)
+    or replaced by a single value if they are all the same
+    For older plotly.js versions the figure is returned unchanged
+    """
+    version = tuple(int(i) for i in plotly.offline.get_plotlyjs_version().split(".")[:2])
+    fig_dict = fig if isinstance(fig, dict) else fig.to_dict()
+    if version < (2, 28):
+        return fig_dict
+    for trace in fig_dict["data"]:
+        compact_arrays(trace)
+    return fig_dict
+
+
+def compact_arrays(container):
+    """Replace the numeric arrays in the (nested) dict container by typed arrays"""
+    for name, value in container.items():
+        if isinstance(value, dict):
+            compact_arrays(value)
+        elif isinstance(value, (list, tuple)) or getattr(value, "ndim", 0) > 0:
+            if len(value) < TYPED_ARRAY_MIN_LENGTH:
+                continue
+            if name in ["text", "hovertext"]:
+                container[name] = round_numeric_text(value)
+            else:
+                encoded = typed_array(value, exact=name == "x")
+                if encoded is not None and json_length(encoded) < json_length(value):
+                    container[name] = encoded
+
+
+def json_length(values):
+    from plotly.io.json import to_json_plotly
+
+    return len(to_json_plotly(values))
+
+
+def round_numeric_text(values):
+    import numpy as np
+
+    values = np.asarray(values)
+    if values.dtype.kind in "iuf":
+        values = np.array([f"{v:.3g}" for v in values.tolist()])
+    if values.ndim == 1 and np.all(values == values[0]):
+        return values[0]
+    return values
+
+
+def typed_array(values, exact=False):
+    """
+    Return a plotly.js typed array spec for numeric values, or None if not numeric
+
+    Integers (also floats without fraction or NaN) become uint8 or int32 if they fit,
+    other values float32 unless exact is set and float32 loses precision
+    """
+    import base64
+    import numpy as np
+
+    try:
+        values = np.asarray(values)
+    except ValueError:  # ragged
+        return None
+    if values.dtype.kind == "b" or values.dtype.kind not in "iuf" or values.size == 0:
+        return None
+    if values.dtype.kind == "f" and np.all(np.isfinite(values)) and np.all(values == np.round(values)):
+        values = values.astype(np.int64)
+    if values.dtype.kind in "iu":
+        if values.min() >= 0 and values.max() < 2**8:
+            values = values.astype(np.uint8)
+        elif values.min() >= -(2**31) and values.max() < 2**31:
+            values = values.astype(np.int32)
+        else:
+            values = values.astype(np.float64)
+    elif not exact or np.array_equal(values.astype(np.float32), values, equal_nan=True):
+        values = values.astype(np.float32)
+    else:
+        values = values.astype(np.float64)
+    dtypes = {np.uint8: "u1", np.int32: "i4", np.float32: "f4", np.float64: "f8"}
+    spec = dict(
+        dtype=dtypes[values.dtype.type],
+        bdata=base64.b64encode(np.ascontiguousarray(values).tobytes()).decode("ascii"),
+    )
+    if values.ndim > 1:
+        spec["shape"] = ",".join(str(i) for i in values.shape)
+    return spec
@@ -0,0 +1,62 @@
+import gzip
+import shutil
+from pathlib import Path
+
+import pysam
+import pytest
+
+from methplotlib.annotation import index_annotation, parse_annotation
+from methplotlib.utils import Region
+
+GTF = Path(__file__).parent.parent / "methplotlib" / "examples" / "g38_locus.gtf.gz"
+
+
+def summary(transcripts):
+    return sorted((t.transcript, t.gene, t.strand, sorted(t.exon_tuples)) for t in transcripts)
+
+
+def test_annotation_store(tmp_path):
+    with gzip.open(GTF, "rt") as gtf, open(tmp_path / "locus.gtf", "w") as plain:
+        shutil.copyfileobj(gtf, plain)
+    window = Region("chr7:5529000-5529500")
+    expected = summary(parse_annotation(str(tmp_path / "locus.gtf"), window, simplify=True))
+
+    store = index_annotation(str(tmp_path / "locus.gtf"))
+
+    assert store == str(tmp_path / "locus.gtf.annotation.npz")
+    assert summary(parse_annotation(str(tmp_path / "locus.gtf"), window, simplify=True)) == expected
+    assert parse_annotation(str(tmp_path / "locus.gtf"), Region("chr1:1-1000")) == []
+
+
+def test_index_annotation_skips_incomplete_lines(tmp_path):
+    with gzip.open(GTF, "rt") as gtf:
+        (tmp_path / "locus.gtf").write_text("\n" + gtf.read() + "chr7\tincomplete\n\n")
+
+    index_annotation(str(tmp_path / "locus.gtf"))
+
+    window = Region("chr7:5529000-5529500")
+    expected = summary(parse_annotation(str(GTF), window))
+    assert summary(parse_annotation(str(tmp_path / "locus.gtf"), window)) == expected
+
+
+def test_parse_annotation_transcripts():
+    transcripts = parse_annotation(str(GTF), Region("chr7:5529000-5529500"))
+
+    assert len(transcripts) == 16
+    assert {t.gene for t in transcripts} == {"ACTB"}
+    assert all(t.exon_tuples == sorted(t.exon_tuples) for t in transcripts)
+
+
+@pytest.mark.parametrize("dropped", [{"gene"}, {"gene", "transcript"}])
+def test_fetch_tabix_without_gene_records(tmp_path, dropped):
+    with gzip.open(GTF, "rt") as gtf:
+        records = [line.split("\t") for line in gtf if not line.startswith("#")]
+    records = sorted((r for r in records if r[2] not in dropped), key=lambda r: (r[0], int(r[3])))
+    (tmp_path / "locus.gtf").write_text("".join("\t".join(r) for r in records))
+    indexed = pysam.tabix_index(str(tmp_path / "locus.gtf"), preset="gff", keep_original=True)
+
+    for window in ["chr7:5529485-5529640", "chr7:5527000-5527500", "chr7:5530600-5530700"]:
+        for simplify in [False, True]:
+            expected = parse_annotation(str(tmp_path / "locus.gtf"), Region(window), simplify)
+            transcripts = parse_annotation(indexed, Region(window), simplify)
+            assert summary(transcripts) == summary(expected)
@@ -0,0 +1,94 @@
+import os
+import shutil
+from argparse import Namespace
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from methplotlib import cache
+from methplotlib.import_methylation import Modification, read_mods
+from methplotlib.utils import Region
+
+EXAMPLES = Path(__file__).parent.parent / "methplotlib" / "examples"
+WINDOW = Region("chr7:5525542-5543028")
+
+
+def make_args(cache_dir, **kwargs):
+    defaults = dict(cache_size=1024, mods=None, smooth=5, threads=1, shard_size=None)
+    return Namespace(cache=str(cache_dir), **dict(defaults, **kwargs))
+
+
+def test_store_load_round_trip(tmp_path):
+    table = pd.DataFrame(
+        {
+            "read_name": pd.Categorical(["r1", "r2", "r1"]),
+            "strand": ["+", "+", "-"],
+            "llr": np.array([0.5, -1.25, np.nan]),
+            "called_sites": np.array([1, 2, 3], dtype=np.int32),
+        },
+        index=pd.Index([10, 20, 30], name="pos"),
+    )
+    start_end = pd.DataFrame({"start": [5, 8], "end": [40, 41]})
+    frequencies = pd.DataFrame({"methylated_frequency": [0.25, 1.0]})
+    mods = [
+        Modification(table, "ont-cram", "calls_m", called_sites=3, start_end_table=start_end),
+        Modification(frequencies, "nanopolish_freq", "calls", called_sites=1),
+    ]
+
+    cache.store(tmp_path, "key", "calls", mods)
+    loaded = cache.load(tmp_path, "key", "calls")
+
+    assert [m.name for m in loaded] == ["calls_m", "calls"]
+    assert [m.data_type for m in loaded] == ["ont-cram", "nanopolish_freq"]
+    assert [m.called_sites for m in loaded] == [3, 1]
+    pd.testing.assert_frame_equal(loaded[0].table, table)
+    pd.testing.assert_frame_equal(loaded[0].start_end_table, start_end)
+    pd.testing.assert_frame_equal(loaded[1].table, frequencies)
+    assert loaded[1].start_end_table is None
+    assert cache.load(tmp_path, "other", "calls") is None
+
+
+def test_cache_key_changes(tmp_path):
+    source = tmp_path / "calls.tsv"
+    source.write_text("a\n")
+    args = make_args(tmp_path)
+    key = cache.cache_key(str(source), WINDOW, args)
+
+    assert cache.cache_key(str(source), WINDOW, make_args(tmp_path, mods="m")) != key
+    assert cache.cache_key(str(source), WINDOW, make_args(tmp_path, smooth=3)) != key
+    assert cache.cache_key(str(source), Region("chr7:1-100"), args) != key
+    os.utime(source, ns=(0, 0))
+    assert cache.cache_key(str(source), WINDOW, args) != key
+    key = cache.cache_key(str(source), WINDOW, args)
+    source.write_text("ab\n")
+    os.utime(source, ns=(0, 0))
+    assert cache.cache_key(str(source), WINDOW, args) != key
+
+
+def test_evict_least_recently_used(tmp_path):
+    table = pd.DataFrame({"value": np.zeros(50000)})
+    mods = [Modification(table, "bedgraph", "calls", called_sites=0)]
+    for i, key in enumerate(["old", "used", "new"]):
+        cache.store(tmp_path, key, "calls", mods)
+        os.utime(tmp_path / f"{key}.npz", (i, i))
+    entry_size = (tmp_path / "old.npz").stat().st_size
+    assert cache.load(tmp_path, "used", "calls") is not None
+
+    cache.evict(tmp_path, max_size=2.5 * entry_size / 1e6)
+
+    assert sorted(p.stem for p in tmp_path.glob("*.npz")) == ["new", "used"]
+
+
+def test_renamed_dataset_from_cache(tmp_path):
+    shutil.copy(EXAMPLES / "meth_freq.tsv.gz", tmp_path / "meth_freq.tsv.gz")
+    filename = str(tmp_path / "meth_freq.tsv.gz")
+    args = make_args(tmp_path / "cache")
+
+    parsed = read_mods(filename, "calls", WINDOW, args)
+    renamed = read_mods(filename, "SAMPLE_X", WINDOW, args)
+
+    assert len(list((tmp_path / "cache").glob("*.npz"))) == 1
+    assert [m.name for m in parsed] == ["calls"]
+    assert [m.name for m in renamed] == ["SAMPLE_X"]
+    pd.testing.assert_frame_equal(renamed[0].table, parsed[0].table)
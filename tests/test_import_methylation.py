@@ -0,0 +1,51 @@
+import pandas as pd
+
+from methplotlib import import_methylation
+from methplotlib.import_methylation import select_window
+from methplotlib.utils import Region
+
+
+def test_select_window_like_pyranges():
+    table = pd.DataFrame(
+        {
+            "Chromosome": ["chr1", "chr1", "chr1", "chr1", "chr2", "chr1"],
+            "Start": [300, 100, 100, 99, 150, 150],
+            "End": [300, 100, 101, 400, 151, 160],
+            "name": ["a", "b", "c", "d", "e", "f"],
+        }
+    )
+    assert select_window(table, Region("chr1:100-200"))["name"].tolist() == ["d", "c", "f"]
+    assert select_window(table, Region("chr1:150-300"))["name"].tolist() == ["d", "f"]
+    assert select_window(table, Region("chr2:1-149")).empty
+
+
+def test_batch_windows_read_file_once(tmp_path):
+    bedgraph = tmp_path / "test.bedgraph"
+    records = [("chr2", 500), ("chr1", 30), ("chr1", 10), ("chr2", 5), ("chr1", 990)]
+    bedgraph.write_text("".join(f"{c}\t{s}\t{s + 20}\t0.5\n" for c, s in records))
+    windows = [Region("chr1:0-15"), Region("chr1:35-100"), Region("chr2:1-600")]
+    kwargs = dict(chromosome="Chromosome", start="Start", end="End", header=None)
+    kwargs["names"] = ["Chromosome", "Start", "End", "Value"]
+    expected = [import_methylation.read_unindexed(str(bedgraph), w, **kwargs) for w in windows]
+    try:
+        import_methylation.set_batch_windows(windows)
+        batch = [import_methylation.read_unindexed(str(bedgraph), w, **kwargs) for w in windows]
+        assert list(import_methylation._preloaded) == [str(bedgraph)]
+    finally:
+        import_methylation.set_batch_windows([])
+    for e, b in zip(expected, batch):
+        assert sorted(e["Start"]) == b["Start"].tolist()
+
+
+def test_read_unindexed_reads_of_chromosome_apart(tmp_path):
+    calls = tmp_path / "calls.tsv"
+    records = [("chrY", 100, "y1"), ("chr1", 100, "r1"), ("chr1", 200, "r2"), ("chrY", 150, "y2")]
+    calls.write_text(
+        "chromosome\tstart\tend\tread_name\n"
+        + "".join(f"{c}\t{s}\t{s}\t{r}\n" for c, s, r in records)
+    )
+    table = import_methylation.read_unindexed(
+        str(calls), Region("chrY:1-1000"), chromosome="chromosome", start="start", end="end",
+        chunksize=2,
+    )
+    assert table["read_name"].tolist() == ["y1", "y2"]
@@ -0,0 +1,22 @@
+import random
+
+import pysam
+
+from methplotlib.indexing import index_file, is_sorted, is_bgzf, TABIX_SPECS
+
+
+def test_index_unsorted_bedgraph(tmp_path):
+    records = [("chr1", start, start + 10, 0.5) for start in range(0, 10000, 10)]
+    records += [("chr2", start, start + 10, 0.1) for start in range(0, 5000, 10)]
+    random.Random(1).shuffle(records)
+    bedgraph = tmp_path / "unsorted.bedgraph"
+    bedgraph.write_text("".join("\t".join(str(f) for f in r) + "\n" for r in records))
+    assert not is_sorted(str(bedgraph), TABIX_SPECS["bedgraph"])
+
+    indexed = index_file(str(bedgraph), chunk_lines=100)
+
+    assert indexed == str(tmp_path / "unsorted.bedgraph.sorted.gz")
+    assert is_bgzf(indexed)
+    assert is_sorted(indexed, TABIX_SPECS["bedgraph"])
+    fetched = list(pysam.TabixFile(indexed).fetch("chr1", 100, 200))
+    assert [int(line.split("\t")[1]) for line in fetched] == list(range(100, 200, 10))
@@ -0,0 +1,60 @@
+import os
+import shutil
+import subprocess
+import sys
+from pathlib import Path
+
+import pytest
+
+ROOT = Path(__file__).parent.parent
+EXAMPLES = ROOT / "methplotlib" / "examples"
+
+
+def run_methplotlib(args, cwd):
+    env = dict(os.environ, PYTHONPATH=str(ROOT))
+    return subprocess.run(
+        [sys.executable, "-c", "from methplotlib.methplotlib import main; main()", *args],
+        cwd=cwd,
+        env=env,
+        capture_output=True,
+        text=True,
+        timeout=300,
+    )
+
+
+@pytest.mark.parametrize("auto_index", [False, True])
+def test_windows_in_processes_with_threads(tmp_path, auto_index):
+    for f in ["ACTB_calls.tsv.gz", "meth_freq.tsv.gz"]:
+        shutil.copy(EXAMPLES / f, tmp_path / f)
+    regions = ["chr7\t5525542\t5530000\n", "chr7\t5530000\t5535000\n", "chr7\t5535000\t5543028\n"]
+    (tmp_path / "regions.bed").write_text("".join(regions))
+
+    result = run_methplotlib(
+        ["-m", "ACTB_calls.tsv.gz", "meth_freq.tsv.gz", "-n", "calls", "frequencies",
+         "--windows", "regions.bed", "--processes", "2", "-t", "2", "-o", "out/{region}.html"]
+        + ["--auto-index"] * auto_index,
+        cwd=tmp_path,
+    )
+
+    assert result.returncode == 0, result.stderr
+    assert len(list((tmp_path / "out").glob("chr7_*.html"))) == 3
+    assert len(list((tmp_path / "out").glob("qc_chr7_*.html"))) == 3
+    if auto_index:
+        assert (tmp_path / "ACTB_calls.tsv.sorted.gz.tbi").is_file()
+
+
+def test_lazy_pages_share_plotlyjs(tmp_path):
+    shutil.copy(EXAMPLES / "meth_freq.tsv.gz", tmp_path / "meth_freq.tsv.gz")
+    (tmp_path / "regions.bed").write_text("chr7\t5525542\t5530000\nchr7\t5530000\t5535000\n")
+
+    result = run_methplotlib(
+        ["-m", "meth_freq.tsv.gz", "-n", "frequencies", "--windows", "regions.bed",
+         "-o", "out/{region}/browser.html", "--lazy"],
+        cwd=tmp_path,
+    )
+
+    assert result.returncode == 0, result.stderr
+    bundles = list(tmp_path.rglob("plotly-*.min.js"))
+    assert [b.parent for b in bundles] == [tmp_path / "out"]
+    for page in (tmp_path / "out").glob("*/*.html"):
+        assert f'<script src="../{bundles[0].name}">' in page.read_text()
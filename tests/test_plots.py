@@ -0,0 +1,50 @@
+import numpy as np
+import pandas as pd
+
+from methplotlib.plots import assign_y_height_per_read, downsample, per_read_heatmap_matrix
+
+
+def test_assign_y_height_per_read():
+    df = pd.DataFrame(
+        {
+            "posmin": [0, 5, 20, 11, 30, 0],
+            "posmax": [10, 25, 40, 15, 35, 50],
+            "HP": [1, 1, 1, 2, 2, 2],
+        },
+        index=pd.Index(["a", "b", "c", "d", "e", "f"], name="read_name"),
+    )
+    heights = assign_y_height_per_read(df, max_coverage=3)["height"].to_dict()
+    assert heights == {"f": 1, "a": 2, "b": 3, "d": 2, "c": 2, "e": 3}
+    phased = assign_y_height_per_read(df, phased=True)["height"].to_dict()
+    assert phased == {"a": 1, "b": 2, "c": 1, "f": 3, "d": 4, "e": 2}
+    assert len(assign_y_height_per_read(df, max_coverage=2)) == 4
+    assert np.issubdtype(assign_y_height_per_read(df)["height"].dtype, np.integer)
+
+
+def test_downsample_keeps_extremes():
+    x = np.arange(10000)
+    y = np.sin(x / 100)
+    y[1234] = 5
+    dx, dy = downsample(x, y, max_points=500)
+    assert len(dx) <= 500
+    assert np.all(np.diff(dx) > 0)
+    assert (dx[0], dx[-1]) == (0, 9999)
+    assert dy.max() == 5 and dy.min() == y.min()
+    assert len(downsample(x[:100], y[:100], max_points=500)[0]) == 100
+
+
+def test_per_read_heatmap_matrix():
+    table = pd.DataFrame(
+        {
+            "pos": [10, 11, 15, 10, 5000],
+            "height": [1, 1, 1, 2, np.nan],
+            "llr_scaled": [1.0, 3.0, 2.0, -1.0, 5.0],
+        }
+    )
+    x, y, z = per_read_heatmap_matrix(table, "llr_scaled")
+    assert x.tolist() == [10, 11, 12, 13, 14, 15]
+    assert y.tolist() == [1, 2]
+    np.testing.assert_equal(z, [[1, 3, np.nan, np.nan, np.nan, 2], [-1] + [np.nan] * 5])
+    x, y, z = per_read_heatmap_matrix(table, "llr_scaled", max_bins=3)
+    assert x.tolist() == [10.5, 12.5, 14.5]
+    np.testing.assert_equal(z, [[2, np.nan, 2], [-1, np.nan, np.nan]])
@@ -0,0 +1,29 @@
+import base64
+import numpy as np
+import plotly.graph_objs as go
+from methplotlib.utils import typed_array, write_lazy_html
+
+
+def decode(spec):
+    return np.frombuffer(base64.b64decode(spec["bdata"]), dtype=spec["dtype"])
+
+
+def test_typed_array():
+    positions = np.array([55255421, 55256001, np.nan, 55430283])
+    spec = typed_array(positions, exact=True)
+    assert spec["dtype"] == "f8"
+    np.testing.assert_array_equal(decode(spec), positions)
+    spec = typed_array([1.0, 2.0, 300.0])
+    assert spec["dtype"] == "i4"
+    np.testing.assert_array_equal(decode(spec), [1, 2, 300])
+    assert typed_array([0, 1, 255])["dtype"] == "u1"
+    assert typed_array([0.25, 0.5])["dtype"] == "f4"
+
+
+def test_write_lazy_html_replaces_sidecars(tmp_path):
+    figures = [go.Figure(go.Scatter(x=[1, 2], y=[3, 4])) for _ in range(2)]
+    plotlyjs = tmp_path / "plotly.min.js"
+    plotlyjs.write_text("")
+    write_lazy_html(figures, tmp_path / "page.html", plotlyjs=plotlyjs)
+    write_lazy_html(figures[:1], tmp_path / "page.html", plotlyjs=plotlyjs)
+    assert [p.name for p in (tmp_path / "page_files").iterdir()] == ["figure0_y.js"]